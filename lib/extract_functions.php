@@ -6,21 +6,17 @@
  * to extract all functions from a PHP file (whose absolute path is given as argument) and
  * return all the functions' names indexed by the line on which they are defined
  *
+ * When given the --batch option instead of a path, it reads absolute paths from its standard
+ * input (one per line), and for each of them outputs one line of JSON, of the form
+ * {"path": "/path/to/file.php", "functions": {...}} or {"path": "/path/to/file.php", "error": "..."}
+ * That saves starting PHP and loading PHP-Parser for every single file
+ *
  * @package        ZomPHP
  */
 
-// fetch the code
-if (count($argv) != 2 || !is_string($path = $argv[1]) || !strlen($path) || $path[0] !== '/') {
+if (count($argv) != 2 || !is_string($arg = $argv[1]) || !strlen($arg) || ($arg[0] !== '/' && $arg !== '--batch')) {
     echo 'Usage: '.$argv[0].' /absolute/path/to_file.php'.PHP_EOL;
-    exit(1);
-}
-if (!is_readable($path)) {
-    echo $path.' does not exist or is not readable'.PHP_EOL;
-    exit(1);
-}
-$code = file_get_contents($path);
-if (!$code) {
-    echo 'Could not read from '.$path.PHP_EOL;
+    echo '       '.$argv[0].' --batch < list_of_absolute_paths'.PHP_EOL;
     exit(1);
 }
 
@@ -54,22 +50,67 @@ class ZomphpFunctionExtractor extends PHPParser_NodeVisitorAbstract
     }
 }
 
-$parser        = new PHPParser_Parser(new PHPParser_Lexer);
-$traverser     = new PHPParser_NodeTraverser;
-$prettyPrinter = new PHPParser_PrettyPrinter_Default;
-$extractor     = new ZomphpFunctionExtractor;
-$traverser->addVisitor($extractor);
+/**
+ * Returns the functions defined in that file, indexed by line number
+ * Throws a RuntimeException if the file can't be read or parsed
+ */
+function zomphpExtractFunctions(PHPParser_Parser $parser, $path) {
+    // fetch the code
+    if (!is_readable($path)) {
+        throw new RuntimeException($path.' does not exist or is not readable');
+    }
+    $code = file_get_contents($path);
+    if (!$code) {
+        throw new RuntimeException('Could not read from '.$path);
+    }
 
-try {
-    // parse...
-    $stmts = $parser->parse($code);
-    // ... and traverse
-    $stmts = $traverser->traverse($stmts);
-} catch (PHPParser_Error $e) {
-    echo 'Parse Error: ', $e->getMessage().PHP_EOL;
-    exit(1);
+    $traverser = new PHPParser_NodeTraverser;
+    $extractor = new ZomphpFunctionExtractor;
+    $traverser->addVisitor($extractor);
+
+    try {
+        // parse...
+        $stmts = $parser->parse($code);
+        // ... and traverse
+        $traverser->traverse($stmts);
+    } catch (PHPParser_Error $e) {
+        throw new RuntimeException('Parse Error: '.$e->getMessage());
+    }
+
+    return $extractor->getZomphpFunctions();
+}
+
+$parser = new PHPParser_Parser(new PHPParser_Lexer);
+
+if ($arg !== '--batch') {
+    try {
+        $result = zomphpExtractFunctions($parser, $arg);
+    } catch (RuntimeException $e) {
+        echo $e->getMessage().PHP_EOL;
+        exit(1);
+    }
+    if ($result) {
+        echo json_encode($result);
+    }
+    exit(0);
 }
 
-if ($result = $extractor->getZomphpFunctions()) {
-    echo json_encode($result);
+while (($line = fgets(STDIN)) !== false) {
+    $path = rtrim($line, "\r\n");
+    if (!strlen($path)) {
+        continue;
+    }
+    $output = array('path' => $path);
+    if ($path[0] !== '/') {
+        $output['error'] = 'Not an absolute path';
+    } else {
+        try {
+            // cast to an object, so that an empty result is still encoded as {}
+            $output['functions'] = (object) zomphpExtractFunctions($parser, $path);
+        } catch (RuntimeException $e) {
+            $output['error'] = $e->getMessage();
+        }
+    }
+    echo json_encode($output).PHP_EOL;
+    flush();
 }
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import imp
+import shutil
+import tempfile
+import logging
+import unittest
+
+ZOMPHP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'zomphp')
+sys.path.insert(0, ZOMPHP_DIR)
+try:
+    import zomphp_settings
+except ImportError:
+    # fall back on the default settings
+    imp.load_source('zomphp_settings', os.path.join(ZOMPHP_DIR, 'zomphp_settings.py.tpl'))
+
+import backend
+import snapshot
+
+
+class FakeBatchingBackend(backend.BatchingBackend):
+    '''
+    Fails to write records for files named 'bad.php', and everything when down
+    '''
+
+    def __init__(self, **kwargs):
+        self.written = []
+        self.down = False
+        super(FakeBatchingBackend, self).__init__(batch_interval=3600, **kwargs)
+
+    def _write_batch(self, records):
+        if self.down or any(filename == 'bad.php' for filename, _, _ in records):
+            raise ValueError('Cannot write %s' % (records, ))
+        self.written.extend(records)
+
+
+class BatchingBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        # failures get logged
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_batches(self):
+        bckend = FakeBatchingBackend(batch_size=2)
+        bckend.record('a.php', 'foo', '1')
+        self.assertEqual(bckend.written, [])
+        bckend.record('a.php', 'bar', '2')
+        self.assertEqual(bckend.written, [('a.php', 'foo', 1), ('a.php', 'bar', 2)])
+
+    def test_bad_record_dropped(self):
+        bckend = FakeBatchingBackend(batch_size=3)
+        for record in (('a.php', 'foo', 1), ('bad.php', 'foo', 1), ('a.php', 'bar', 2)):
+            bckend.record(*record)
+        self.assertEqual(bckend.written, [('a.php', 'foo', 1), ('a.php', 'bar', 2)])
+        self.assertEqual(bckend.dropped_records, 1)
+        # and it doesn't get in the way of the next ones
+        for record in (('b.php', 'foo', 1), ('b.php', 'bar', 2), ('b.php', 'baz', 3)):
+            bckend.record(*record)
+        self.assertEqual(len(bckend.written), 5)
+        self.assertEqual(bckend.dropped_records, 1)
+
+    def test_lone_bad_record(self):
+        bckend = FakeBatchingBackend(batch_size=10)
+        bckend.record('bad.php', 'foo', 1)
+        # can't tell it from the backend being down, it's kept...
+        self.assertRaises(ValueError, bckend.flush)
+        self.assertEqual(bckend.dropped_records, 0)
+        # ... until it fails next to records that can be written
+        bckend.record('a.php', 'foo', 1)
+        bckend.flush()
+        self.assertEqual(bckend.written, [('a.php', 'foo', 1)])
+        self.assertEqual(bckend.dropped_records, 1)
+
+    def test_backend_down(self):
+        bckend = FakeBatchingBackend(batch_size=2)
+        bckend.down = True
+        bckend.record('a.php', 'foo', 1)
+        self.assertRaises(ValueError, bckend.record, 'a.php', 'bar', 2)
+        # no more flushing on size while failing
+        bckend.record('a.php', 'baz', 3)
+        self.assertEqual(bckend.dropped_records, 0)
+        bckend.down = False
+        bckend.flush()
+        self.assertEqual(sorted(bckend.written), [('a.php', 'bar', 2), ('a.php', 'baz', 3), ('a.php', 'foo', 1)])
+
+    def test_many_bad_records_first(self):
+        bckend = FakeBatchingBackend(batch_size=100)
+        bad = [('bad.php', 'f%d' % idx, idx) for idx in range(backend.BatchingBackend._MAX_FAILURES_IF_DOWN)]
+        good = [('a.php', 'f%d' % idx, idx) for idx in range(50)]
+        bckend._buffer.extend(bad + good)
+        self.assertRaises(ValueError, bckend.flush)
+        # the ones that failed went last...
+        bckend.flush()
+        # ... so that the others could be written, and then the bad ones got dropped
+        self.assertEqual(sorted(bckend.written), sorted(good))
+        self.assertEqual(bckend.dropped_records, len(bad))
+
+    def test_max_buffered(self):
+        bckend = FakeBatchingBackend(batch_size=2, max_buffered=3)
+        bckend.down = True
+        bckend.record('a.php', 'f1', 1)
+        self.assertRaises(ValueError, bckend.record, 'a.php', 'f2', 2)
+        for idx in range(3, 6):
+            bckend.record('a.php', 'f%d' % idx, idx)
+        self.assertEqual(bckend.dropped_records, 2)
+        bckend.down = False
+        bckend.flush()
+        self.assertEqual(sorted(bckend.written), [('a.php', 'f%d' % idx, idx) for idx in range(3, 6)])
+
+
+class SqliteBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix='zomphp_test.')
+        self.bckend = backend.SqliteBackend(os.path.join(self._dir, 'zomphp.sqlite'), batch_size=1, counting=True)
+
+    def tearDown(self):
+        self.bckend.close()
+        shutil.rmtree(self._dir)
+
+    def test_counts_hits(self):
+        self.assertTrue(self.bckend.counts_hits)
+        bckend = backend.SqliteBackend(os.path.join(self._dir, 'no_counts.sqlite'))
+        self.assertFalse(bckend.counts_hits)
+        self.assertIsNone(bckend.file_counts('/srv/app/a.php'))
+        bckend.close()
+
+    def test_non_ascii_paths(self):
+        # only the second one is valid UTF-8
+        for filename in ('/srv/\xe9.php', '/srv/caf\xc3\xa9.php'):
+            self.bckend.record(filename, 'foo', 12)
+            self.bckend.increment({(filename, 'foo', '12'): 3})
+            self.assertTrue(self.bckend.likely_belongs(filename, 'foo'))
+            self.assertEqual(self.bckend.next_func(filename, 1), 'foo')
+            self.assertEqual(self.bckend.file_records(filename), [(12, 'foo')])
+            self.assertEqual(self.bckend.file_counts(filename), [(12, 'foo', 3)])
+        self.assertEqual(self.bckend.dropped_records, 0)
+        # unicode lookups work for UTF-8 paths
+        self.assertTrue(self.bckend.likely_belongs(u'/srv/caf\xe9.php', u'foo'))
+
+
+class NoStrictBackend(backend.BaseBackend):
+
+    @property
+    def supports_strict(self):
+        return False
+
+    def likely_belongs(self, filename, function):
+        return False
+
+
+class StrictSupportTest(unittest.TestCase):
+
+    def test_refused(self):
+        bckend = NoStrictBackend()
+        self.assertRaises(NotImplementedError, bckend.process_file, '/nonexistent.php', strict=True)
+        self.assertRaises(NotImplementedError, bckend.process_directory, '/nonexistent', strict=True)
+        self.assertEqual(bckend._nb_files_processed, 0)
+
+    def test_snapshot_without_line_numbers(self):
+        directory = tempfile.mkdtemp(prefix='zomphp_test.')
+        try:
+            path = os.path.join(directory, 'snapshot')
+            snapshot.write_snapshot(path, [('/srv/app/a.php', 'foo', 0)], line_numbers=False)
+            self.assertFalse(backend.SnapshotBackend(path).supports_strict)
+            snapshot.write_snapshot(path, [('/srv/app/a.php', 'foo', 12)])
+            self.assertTrue(backend.SnapshotBackend(path).supports_strict)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
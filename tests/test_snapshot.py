@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'zomphp'))
+
+import snapshot
+
+
+RECORDS = [('/srv/app/a.php', 'foo', 12),
+           ('/srv/app/a.php', 'bar', 40),
+           ('/srv/app/b.php', 'foo', 3),
+           (u'/srv/app/\xe9.php', u'caf\xe9', 7)]
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix='zomphp_test.')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _path(self, name):
+        return os.path.join(self._dir, name)
+
+    def _write(self, name, records, compress=False, line_numbers=True):
+        path = self._path(name)
+        snapshot.write_snapshot(path, records, compress=compress, line_numbers=line_numbers)
+        return snapshot.Snapshot(path)
+
+    def _check_lookups(self, snap):
+        self.assertEqual(len(snap), len(RECORDS))
+        self.assertTrue(snap.likely_belongs('/srv/app/a.php', 'foo'))
+        self.assertTrue(snap.likely_belongs('/srv/app/a.php', 'bar'))
+        self.assertFalse(snap.likely_belongs('/srv/app/b.php', 'bar'))
+        self.assertFalse(snap.likely_belongs('/srv/app/c.php', 'foo'))
+        self.assertTrue(snap.likely_belongs(u'/srv/app/\xe9.php', u'caf\xe9'))
+        self.assertEqual(snap.next_func('/srv/app/a.php', 1), 'foo')
+        self.assertEqual(snap.next_func('/srv/app/a.php', 12), 'foo')
+        self.assertEqual(snap.next_func('/srv/app/a.php', 13), 'bar')
+        self.assertIsNone(snap.next_func('/srv/app/a.php', 41))
+        self.assertIsNone(snap.next_func('/srv/app/c.php', 1))
+        self.assertEqual(sorted(snap.file_records('/srv/app/a.php')), [(12, 'foo'), (40, 'bar')])
+        self.assertEqual(snap.file_records('/srv/app/c.php'), [])
+        encoded = [(filename.encode('utf-8'), function.encode('utf-8'), lineno) for filename, function, lineno in RECORDS]
+        self.assertEqual(sorted(snap), sorted(encoded))
+
+    def test_round_trip(self):
+        self._check_lookups(self._write('plain', RECORDS))
+
+    def test_compressed(self):
+        self._check_lookups(self._write('compressed', RECORDS, compress=True))
+
+    def test_duplicates(self):
+        self.assertEqual(snapshot.write_snapshot(self._path('dups'), RECORDS + RECORDS[:2]), len(RECORDS))
+
+    def test_empty(self):
+        for compress in (False, True):
+            snap = self._write('empty', [], compress=compress)
+            self.assertEqual(len(snap), 0)
+            self.assertFalse(snap.likely_belongs('/srv/app/a.php', 'foo'))
+            self.assertIsNone(snap.next_func('/srv/app/a.php', 1))
+            self.assertEqual(snap.file_records('/srv/app/a.php'), [])
+            self.assertEqual(list(snap), [])
+            snap.close()
+
+    def test_merge(self):
+        self._write('first', RECORDS[:3]).close()
+        self._write('second', RECORDS[2:], compress=True).close()
+        self._write('empty', []).close()
+        output = self._path('merged')
+        # the output gets overwritten, not merged into
+        self._write('merged', [('/srv/app/old.php', 'old', 1)]).close()
+        inputs = [self._path(name) for name in ('first', 'second', 'empty')]
+        self.assertEqual(snapshot.merge_snapshots(output, inputs), len(RECORDS))
+        snap = snapshot.Snapshot(output)
+        self._check_lookups(snap)
+        self.assertTrue(snap.line_numbers)
+        self.assertFalse(snap.likely_belongs('/srv/app/old.php', 'old'))
+
+    def test_line_numbers(self):
+        self.assertTrue(self._write('with', RECORDS).line_numbers)
+        self.assertFalse(self._write('without', [(filename, function, 0) for filename, function, _ in RECORDS], line_numbers=False).line_numbers)
+        self.assertFalse(self._write('compressed', [], compress=True, line_numbers=False).line_numbers)
+        # a merged snapshot only has line numbers if all the inputs do
+        output = self._path('merged')
+        snapshot.merge_snapshots(output, [self._path('with'), self._path('without')])
+        self.assertFalse(snapshot.Snapshot(output).line_numbers)
+        snapshot.merge_snapshots(output, [self._path('with'), self._path('with')])
+        self.assertTrue(snapshot.Snapshot(output).line_numbers)
+
+    def test_version_1(self):
+        # same as version 2, without the flags byte
+        path = self._path('v2')
+        snapshot.write_snapshot(path, RECORDS)
+        with open(path, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+        with open(self._path('v1'), 'wb') as snapshot_file:
+            snapshot_file.write(snapshot.MAGIC + '\x01' + data[len(snapshot.MAGIC) + 2:])
+        snap = snapshot.Snapshot(self._path('v1'))
+        self._check_lookups(snap)
+        self.assertFalse(snap.line_numbers)
+
+    def test_not_a_snapshot(self):
+        with open(self._path('garbage'), 'wb') as garbage:
+            garbage.write('not a snapshot at all')
+        with self.assertRaises(ValueError):
+            snapshot.Snapshot(self._path('garbage'))
+
+
+if __name__ == '__main__':
+    unittest.main()
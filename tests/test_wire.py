@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'zomphp'))
+
+import wire
+
+
+RECORDS = [('/srv/app/a.php', 'foo', 12),
+           ('/srv/app/a.php', 'bar', 40),
+           ('/srv/app/b.php', 'foo', 3),
+           ('/srv/app/a.php', 'foo', 12)]
+
+
+class FramedProtocolTest(unittest.TestCase):
+
+    def _encode(self):
+        encoder = wire.FramedEncoder()
+        # names declared in a previous frame must be re-used in the next ones
+        return encoder.encode(RECORDS[:2]) + encoder.encode(RECORDS[2:])
+
+    def test_round_trip(self):
+        decoder = wire.FramedDecoder()
+        self.assertEqual(decoder.feed(self._encode()), RECORDS)
+        self.assertEqual(decoder.close(), [])
+        self.assertEqual(decoder.errors, 0)
+
+    def test_split_at_every_byte(self):
+        data = self._encode()
+        for split in xrange(len(data) + 1):
+            decoder = wire.FramedDecoder()
+            records = decoder.feed(data[:split]) + decoder.feed(data[split:])
+            self.assertEqual(records, RECORDS, 'split at %d' % split)
+            self.assertEqual(decoder.errors, 0)
+
+    def test_one_byte_at_a_time(self):
+        decoder = wire.FramedDecoder()
+        records = []
+        for byte in self._encode():
+            records.extend(decoder.feed(byte))
+        self.assertEqual(records, RECORDS)
+
+    def test_new_decoder(self):
+        self.assertIsInstance(wire.new_decoder(self._encode()), wire.FramedDecoder)
+        self.assertIsInstance(wire.new_decoder('/srv/app/a.php:foo:12\n'), wire.TextDecoder)
+
+    def test_bad_magic(self):
+        with self.assertRaises(wire.ProtocolError):
+            wire.FramedDecoder().feed('\x00ZPX\x01')
+
+    def test_unknown_frame_type(self):
+        with self.assertRaises(wire.ProtocolError):
+            wire.FramedDecoder().feed(wire.MAGIC + chr(wire.VERSION) + '\x09\x00\x00\x00\x00')
+
+    def test_many_records(self):
+        # too many for a single frame
+        records = [('/srv/app/a.php', 'f%d' % (idx % 100), idx) for idx in xrange(100000)]
+        data = wire.FramedEncoder().encode(records)
+        decoder = wire.FramedDecoder()
+        self.assertEqual(decoder.feed(data), records)
+        self.assertEqual(decoder.errors, 0)
+
+    def test_name_too_long(self):
+        encoder = wire.FramedEncoder()
+        self.assertRaises(ValueError, encoder.encode, [('/srv/app/a.php', 'f', 1), ('/' + 'a' * wire.MAX_FRAME_SIZE, 'f', 1)])
+        # nothing got encoded, the connection's still usable
+        decoder = wire.FramedDecoder()
+        self.assertEqual(decoder.feed(encoder.encode(RECORDS)), RECORDS)
+
+    def test_undeclared_names(self):
+        # a records frame, without any declarations
+        data = wire.MAGIC + chr(wire.VERSION) + struct.pack('!BIIII', wire.FRAME_RECORDS, 12, 0, 0, 12)
+        decoder = wire.FramedDecoder()
+        self.assertEqual(decoder.feed(data), [])
+        self.assertEqual(decoder.errors, 1)
+
+    def test_truncated_frame(self):
+        decoder = wire.FramedDecoder()
+        decoder.feed(self._encode()[:-1])
+        decoder.close()
+        self.assertEqual(decoder.errors, 1)
+
+
+class TextProtocolTest(unittest.TestCase):
+
+    def test_split_at_every_byte(self):
+        data = ''.join('%s:%s:%d\n' % record for record in RECORDS)
+        expected = ['%s:%s:%d' % record for record in RECORDS]
+        for split in xrange(len(data) + 1):
+            decoder = wire.TextDecoder()
+            self.assertEqual(decoder.feed(data[:split]) + decoder.feed(data[split:]) + decoder.close(), expected, 'split at %d' % split)
+
+    def test_partial_line_on_close(self):
+        decoder = wire.TextDecoder()
+        self.assertEqual(decoder.feed('/srv/app/a.php:foo:12\n/srv/app/a.php:ba'), ['/srv/app/a.php:foo:12'])
+        self.assertEqual(decoder.close(), ['/srv/app/a.php:ba'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import re
+import bisect
 import sys
 import os
-import subprocess
-import json
+import shutil
+import errno
+import collections
+import tempfile
 import datetime
+import time
+import sqlite3
+import multiprocessing
+import multiprocessing.util
 
 import pymongo
 
 from zomphp_settings import BACKEND_CLASS_NAME, BACKEND_KWARGS
+from extractor import FunctionExtractor, ExtractionCache
+from utils import get_setting
+from report import CollectingReporter
+from snapshot import Snapshot
+from profiling import Profiler, NullProfiler
 
 
 class BaseBackend(object):
@@ -37,82 +50,267 @@ class BaseBackend(object):
         '''
         raise NotImplementedError
 
+    @property
+    def supports_strict(self):
+        '''
+        Must be False if this backend doesn't record line numbers, and then can't support `next_func`
+        '''
+        return True
+
+    def file_records(self, filename):
+        '''
+        Can return all the (lineno, function) pairs recorded for that filename, in one go,
+        so that files can be analyzed without querying the backend for every single function
+        Returns None if not supported (then `likely_belongs` and `next_func` get used instead)
+        '''
+        return None
+
+    def iter_records(self):
+        '''
+        Can yield all the recorded (filename, function, lineno) tuples, to export snapshots
+        (lineno being 0 if the backend doesn't record line numbers)
+        '''
+        raise NotImplementedError('%s does not support exporting its records' % self.__class__.__name__)
+
+    def increment(self, counts):
+        '''
+        Can add those hit counts, a dict mapping (filename, function, lineno) tuples to
+        numbers of calls; called periodically by the daemon if HIT_COUNT_INTERVAL is set
+        Backends that don't count hits just ignore them
+        '''
+        pass
+
+    @property
+    def counts_hits(self):
+        '''
+        Must be True iff this backend supports `increment` and `file_counts`
+        '''
+        return False
+
+    def file_counts(self, filename):
+        '''
+        Can return all the (lineno, function, hits) triples counted for that filename
+        (lineno being 0 if the backend doesn't record line numbers)
+        Returns None if not supported
+        '''
+        return None
+
+    def flush(self):
+        '''
+        Must write out anything `record` might have buffered; called periodically
+        by the daemon, and on shutdown
+        '''
+        pass
+
+    def rollup(self):
+        '''
+        Can move the recorded entries to durable storage; called periodically by the
+        daemon if ROLLUP_INTERVAL is set, or by `zomphp.py --rollup`
+        '''
+        pass
+
+    def _worker_backend_factory(self):
+        '''
+        Returns a (callable, args) couple creating an equivalent backend in worker processes
+        (see `process_directory`), override it if your backend isn't the one set in the settings
+        '''
+        return get_new_backend, ()
+
     # always call super if you have a custom constructor
     def __init__(self):
         self._functions_found = 0
         self._functions_used = 0
+        self._functions_rarely_used = 0
         self._nb_files_processed = 0
+        self._extractor = None
+        self.profiler = NullProfiler()
+        # the number of records that couldn't be written
+        self.dropped_records = 0
 
     # DON'T OVERRIDE THE REMAINING FUNCTIONS
 
+    def close(self):
+        '''
+        Flushes the backend, and stops the extractor process if any
+        '''
+        self.flush()
+        if self._extractor is not None:
+            self._extractor.close()
+            self._extractor = None
+
     @property
     def stats(self):
-        return 'Processed %d files. Found %d functions, of which %d have been used' % (self._nb_files_processed, self._functions_found, self._functions_used)
+        return 'Processed %d files. Found %d functions, of which %d have been used (%d of them rarely)' % (self._nb_files_processed, self._functions_found, self._functions_used, self._functions_rarely_used)
 
-    def _function_called(self, filename, function, lineno, strict=False, translator=None):
+    def _function_called(self, filename, function, lineno, strict=False, translator=None, records=None):
         '''
         Returns True if that function has been called
+        `records` is the file's FileRecords object, if the backend supports prefetching
         '''
+        if records is not None:
+            if strict:
+                return records.next_func(lineno) == function
+            else:
+                return records.likely_belongs(function)
         if translator:
             filename = translator.translate(filename)
         if strict:
-            return self.next_func(filename, lineno) == function
+            with self.profiler.phase('backend.next_func'):
+                return self.next_func(filename, lineno) == function
         else:
-            return self.likely_belongs(filename, function)
+            with self.profiler.phase('backend.likely_belongs'):
+                return self.likely_belongs(filename, function)
 
     def process_raw_data(self, data):
         '''
         `data` is a string formatted in the ZomPHP usual form, i.e. path/to/file.php:funcName:lineNo
         '''
-        logging.debug('Processing raw data in backend: %s' % data)
+        # that one's on the daemon's hot path, let logging do the formatting only if needed
+        logging.debug('Processing raw data in backend: %s', data)
+        self.record(*self.parse_raw_data(data))
+
+    @staticmethod
+    def parse_raw_data(data):
+        '''
+        Returns the (filename, function, lineno) tuple for that raw data (see `process_raw_data`)
+        '''
         data, _, lineno = data.rpartition(':')
         filename, _, function = data.rpartition(':')
-        self.record(filename, function, lineno)
+        return filename, function, lineno
 
-    def process_file(self, path, strict=False, translator=None):
+    def process_file(self, path, strict=False, translator=None, reporter=None, min_hits=None):
         '''
         Parses a file and marks the unused functions as such!
         `strict` might find more false negatives, but less false positives
+        If given a reporter (see report.py), the file is left untouched, and
+        the results are sent to the reporter instead
+        If given `min_hits`, functions called fewer times than that get marked as rarely used
+        (requires a backend counting hits); functions that have been recorded but never
+        counted are considered used
         Returns the real path of the file on success
         '''
-        return self._do_process_file(path, strict=strict, translator=translator)
+        self._check_strict(strict)
+        return self._do_process_file(path, strict=strict, translator=translator, reporter=reporter, min_hits=min_hits)
+
+    def _check_strict(self, strict):
+        if strict and not self.supports_strict:
+            raise NotImplementedError('%s does not support the \'--strict\' option!' % self.__class__.__name__)
 
-    def _do_process_file(self, path, strict=False, translator=None, start_date=None):
+    def _do_process_file(self, path, strict=False, translator=None, start_date=None, reporter=None, min_hits=None):
         self._nb_files_processed += 1
         # PHP always unrolls symlinks, at least something it does right :-)
         path = os.path.realpath(path)
+        start = time.time()
+        try:
+            return self._do_process_real_file(path, strict=strict, translator=translator, start_date=start_date, reporter=reporter, min_hits=min_hits)
+        finally:
+            self.profiler.file_done(path, time.time() - start)
+
+    def _do_process_real_file(self, path, strict, translator, start_date, reporter, min_hits):
         logging.info('Processing file %s' % path)
-        file_functions = self._get_file_functions(path)
+        with self.profiler.phase('extract'):
+            file_functions = self._get_file_functions(path)
         logging.debug('Found functions %s' % file_functions)
         if not file_functions:
             # nothing to do
             return
+        with self.profiler.phase('backend.file_records'):
+            records = self._get_file_records(path, translator=translator)
+        counts = None
+        if min_hits:
+            with self.profiler.phase('backend.file_counts'):
+                counts = self._get_file_counts(path, translator=translator)
+        check = 'next_func' if strict else 'likely_belongs'
 
-        current_line_nb = 0
-        new_content = bytes()
+        # first find out which warnings to insert, and before which lines
+        warnings = {}
         with open(path, 'r') as source:
-            while True:
-                current_line = bytes(source.readline())
-                current_line_nb += 1
-                if not current_line:
-                    # we're done
-                    break
+            # the functions already flagged on the lines right above the current one
+            flagged = set()
+            for current_line_nb, current_line in enumerate(source, 1):
                 for function in file_functions.get(current_line_nb, []):
                     self._functions_found += 1
-                    if self._function_called(path, function, current_line_nb, strict, translator=translator):
-                        logging.debug('Function %s:%s:%d appears to be used' % (path, function, current_line_nb))
+                    used = self._function_called(path, function, current_line_nb, strict, translator=translator, records=records)
+                    hits = None
+                    if used and counts is not None:
+                        hits = counts.hits(function, current_line_nb if strict else None)
+                    rarely_used = hits is not None and hits < min_hits
+                    if reporter is not None:
+                        reporter.report(path, function, current_line_nb, used, check, hits, rarely_used)
+                    if used:
                         self._functions_used += 1
+                    if rarely_used:
+                        self._functions_rarely_used += 1
+                    if used and not rarely_used:
+                        logging.debug('Function %s:%s:%d appears to be used' % (path, function, current_line_nb))
+                    elif function in flagged:
+                        logging.debug('Function %s:%s:%d has already been flagged' % (path, function, current_line_nb))
                     else:
-                        logging.debug('Flagging %s:%s:%d as not used!' % (path, function, current_line_nb))
-                        new_content += bytes('%s\n' % self._generate_warning(function, start_date=start_date))
-                new_content += current_line
+                        logging.debug('Flagging %s:%s:%d as %s!' % (path, function, current_line_nb, 'rarely used' if used else 'not used'))
+                        warnings.setdefault(current_line_nb, []).append(self._generate_warning(function, start_date=start_date, hits=hits))
+                flagged_function = self._parse_warning(current_line)
+                if flagged_function is None:
+                    flagged.clear()
+                else:
+                    flagged.add(flagged_function)
 
-        # let's replace the old file with the new content
-        with open(path, 'w') as new_file:
-            new_file.write(new_content)
+        if reporter is not None:
+            # don't touch the file
+            return path
+        if not warnings:
+            logging.debug('Nothing to flag in %s, leaving it untouched' % path)
+            return path
+
+        # then stream the new content into a temp file, and swap it in place of the old one
+        with self.profiler.phase('rewrite'):
+            with open(path, 'r') as source:
+                with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), prefix='.zomphp.', delete=False) as new_file:
+                    try:
+                        for current_line_nb, current_line in enumerate(source, 1):
+                            for warning in warnings.get(current_line_nb, []):
+                                new_file.write('%s\n' % warning)
+                            new_file.write(current_line)
+                        new_file.flush()
+                        stat = os.stat(path)
+                        shutil.copymode(path, new_file.name)
+                        try:
+                            os.chown(new_file.name, stat.st_uid, stat.st_gid)
+                        except OSError as ex:
+                            # only root can give files away
+                            if ex.errno != errno.EPERM:
+                                raise
+                    except:
+                        os.remove(new_file.name)
+                        raise
+            if stat.st_nlink > 1:
+                # renaming would break the links, copy the new content over instead
+                shutil.copyfile(new_file.name, path)
+                os.remove(new_file.name)
+            else:
+                os.rename(new_file.name, path)
 
         return path
 
+    def _get_file_records(self, path, translator=None):
+        '''
+        Returns a FileRecords object for that file, or None if the backend doesn't support it
+        '''
+        if translator:
+            path = translator.translate(path)
+        records = self.file_records(path)
+        return None if records is None else FileRecords(records)
+
+    def _get_file_counts(self, path, translator=None):
+        '''
+        Returns a FileCounts object for that file
+        '''
+        if translator:
+            path = translator.translate(path)
+        counts = self.file_counts(path)
+        if counts is None:
+            raise NotImplementedError('%s does not count hits' % self.__class__.__name__)
+        return FileCounts(counts)
+
     def _should_process_file(self, filename):
         '''
         Should return True iff we want to process that file,
@@ -140,32 +338,147 @@ class BaseBackend(object):
                 return None
         return abs_path
 
-    def process_directory(self, directory_path, strict=False, translator=None, ignore_sub_dirs=[]):
-        logging.debug('Processing directory %s' % directory_path)
-        start_date = datetime.datetime.now()
-        for root, _, files in os.walk(directory_path):
+    def _iter_directory_files(self, directory_path, ignore_sub_dirs):
+        '''
+        Yields the absolute paths of all the files to process in that directory
+        '''
+        walker = os.walk(directory_path)
+        while True:
+            with self.profiler.phase('walk'):
+                try:
+                    root, _, files = next(walker)
+                except StopIteration:
+                    return
             for rel_path in files:
                 abs_path = self._will_process_file(root, rel_path, ignore_sub_dirs)
                 if abs_path:
-                    self._do_process_file(abs_path, strict=strict, translator=translator, start_date=start_date)
+                    yield abs_path
 
-    @staticmethod
-    def _generate_warning(function, start_date=None):
-        return '// ZomPHP warning : the function %s seems be be unused (%s)' % (function, start_date if start_date else datetime.datetime.now())
+    def process_directory(self, directory_path, strict=False, translator=None, ignore_sub_dirs=[], jobs=1, reporter=None, min_hits=None):
+        '''
+        If `jobs` > 1, files are processed by that many worker processes, each with its own backend
+        See `process_file` for `reporter` and `min_hits`
+        '''
+        self._check_strict(strict)
+        logging.debug('Processing directory %s' % directory_path)
+        start_date = datetime.datetime.now()
+        paths = self._iter_directory_files(directory_path, ignore_sub_dirs)
+        if jobs <= 1:
+            for abs_path in paths:
+                self._do_process_file(abs_path, strict=strict, translator=translator, start_date=start_date, reporter=reporter, min_hits=min_hits)
+            return
+        profile = not isinstance(self.profiler, NullProfiler)
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(self._worker_backend_factory(), strict, translator, start_date, reporter is not None, profile, min_hits))
+        try:
+            for counters, entries, profile_data in pool.imap_unordered(_process_file_in_worker, paths, chunksize=16):
+                self._add_counters(counters)
+                if profile_data is not None:
+                    self.profiler.merge_data(profile_data)
+                for entry in entries:
+                    reporter.report(*entry)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
-    @staticmethod
-    def _get_file_functions(path):
+    @property
+    def _counters(self):
+        return (self._nb_files_processed, self._functions_found, self._functions_used, self._functions_rarely_used)
+
+    def _add_counters(self, counters):
+        nb_files_processed, functions_found, functions_used, functions_rarely_used = counters
+        self._nb_files_processed += nb_files_processed
+        self._functions_found += functions_found
+        self._functions_used += functions_used
+        self._functions_rarely_used += functions_rarely_used
+
+    _WARNING_PREFIX = '// ZomPHP warning : the function '
+    _WARNING_SUFFIX = ' seems be be unused'
+    _RARELY_USED_WARNING_SUFFIX = ' seems to be rarely used'
+
+    @classmethod
+    def _generate_warning(cls, function, start_date=None, hits=None):
+        '''
+        `hits` is the number of times that function has been called, for rarely used ones
+        '''
+        if hits is None:
+            suffix = cls._WARNING_SUFFIX
+        else:
+            suffix = '%s (%d calls)' % (cls._RARELY_USED_WARNING_SUFFIX, hits)
+        return '%s%s%s (%s)' % (cls._WARNING_PREFIX, function, suffix, start_date if start_date else datetime.datetime.now())
+
+    @classmethod
+    def _parse_warning(cls, line):
+        '''
+        Returns the function's name if that line is a warning we've inserted, None otherwise
+        '''
+        line = line.strip()
+        if not line.startswith(cls._WARNING_PREFIX):
+            return None
+        for suffix in (cls._WARNING_SUFFIX, cls._RARELY_USED_WARNING_SUFFIX):
+            function, found, _ = line[len(cls._WARNING_PREFIX):].partition(suffix)
+            if found:
+                return function
+        return None
+
+    def _get_file_functions(self, path):
         '''
         Returns the result from lib/extract_functions.php
         '''
-        # ugly, but eh...
-        extract_exec = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib', 'extract_functions.php')
-        try:
-            data = subprocess.check_output('%s "%s"' % (extract_exec, path), shell=True)
-            return {int(k): v for k, v in json.loads(data).items()} if data else {}
-        except subprocess.CalledProcessError as ex:
-            logging.error('Failed to extract functions from %s: %s' % (path, ex.output))
-            return {}
+        if self._extractor is None:
+            self._extractor = FunctionExtractor(cache=ExtractionCache.build_cache(get_setting('EXTRACTION_CACHE_DIR')))
+        return self._extractor.extract(path)
+
+
+class FileRecords(object):
+    '''
+    All the functions recorded for a given file, kept sorted by line number
+    to answer `likely_belongs` and `next_func` in memory
+    '''
+
+    def __init__(self, records):
+        records = sorted(records)
+        self._linenos = [lineno for lineno, _ in records]
+        self._functions = [function for _, function in records]
+        self._function_set = set(self._functions)
+
+    def likely_belongs(self, function):
+        return function in self._function_set
+
+    def next_func(self, lineno):
+        idx = bisect.bisect_left(self._linenos, lineno)
+        return self._functions[idx] if idx < len(self._functions) else None
+
+
+class FileCounts(object):
+    '''
+    All the hit counts for a given file, kept sorted by line number
+    '''
+
+    def __init__(self, counts):
+        counts = sorted(counts)
+        self._linenos = [lineno for lineno, _, _ in counts]
+        self._functions = [function for _, function, _ in counts]
+        self._hits = [hits for _, _, hits in counts]
+        # function => total hits, over all the line numbers it's been counted at
+        self._function_hits = {}
+        for _, function, hits in counts:
+            self._function_hits[function] = self._function_hits.get(function, 0) + hits
+
+    def hits(self, function, lineno=None):
+        '''
+        Returns how many times that function has been called, or None if it's never been counted
+        If given a line number, only counts the calls recorded for the very next function
+        after that line (the same way `next_func` works), if it's that one
+        '''
+        if lineno is None:
+            return self._function_hits.get(function)
+        idx = bisect.bisect_left(self._linenos, lineno)
+        if idx < len(self._functions) and self._functions[idx] == function:
+            return self._hits[idx]
+        return None
 
 
 class DummyBackend(BaseBackend):
@@ -174,30 +487,273 @@ class DummyBackend(BaseBackend):
     '''
 
     def record(self, filename, function, lineno):
-        logging.debug('DummyBackend received: %s:%s:%s' % (filename, fucntion, lineno))
+        logging.debug('DummyBackend received: %s:%s:%s' % (filename, function, lineno))
+
+
+class BatchingBackend(BaseBackend):
+    '''
+    A base class for backends that buffer new records, and write them out in batches as soon as there are
+    `batch_size` of them or `batch_interval` seconds have elapsed since the last write (set `batch_size` to 1 to disable)
+    Subclasses must implement `_write_batch` instead of `record`
+    If writing a batch fails, its records get retried one by one, and the ones that fail on their own get dropped;
+    if none of them can be written, the backend's more likely down: then they're kept for the next flush, which
+    only happens after `batch_interval`, and at most `max_buffered` records are kept (the oldest ones get dropped)
+    '''
+
+    # how many records of a failed batch get retried one by one before giving up if none of them can be written
+    _MAX_FAILURES_IF_DOWN = 10
+
+    def __init__(self, batch_size=1000, batch_interval=1, max_buffered=100000):
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._buffer = collections.deque(maxlen=max_buffered)
+        self._last_flush = time.time()
+        self._flush_failed = False
+        super(BatchingBackend, self).__init__()
+
+    def _write_batch(self, records):
+        '''
+        Must write that list of (filename, function, lineno) tuples to the backend
+        '''
+        raise NotImplementedError
+
+    def record(self, filename, function, lineno):
+        if len(self._buffer) == self._buffer.maxlen:
+            # the deque drops the oldest one
+            self.dropped_records += 1
+        self._buffer.append((filename, function, int(lineno)))
+        # don't hammer a backend that's failing
+        full = len(self._buffer) >= self._batch_size and not self._flush_failed
+        if full or time.time() - self._last_flush >= self._batch_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        if not self._buffer:
+            return
+        records = list(self._buffer)
+        self._buffer.clear()
+        logging.debug('Flushing %d records' % len(records))
+        for start in xrange(0, len(records), self._batch_size):
+            batch = records[start:start + self._batch_size]
+            try:
+                self._write_batch(batch)
+            except:
+                logging.exception('Failed to write a batch of %d records, retrying them one by one' % len(batch))
+                failed = self._write_one_by_one(batch)
+                if failed is not None:
+                    # keep them all for the next try, the ones that just failed last so that bad records can't stay ahead forever
+                    self._buffer.extend(batch[len(failed):] + records[start + len(batch):] + failed)
+                    self._flush_failed = True
+                    logging.error('Keeping %d records for the next flush (%d dropped so far)' % (len(self._buffer), self.dropped_records))
+                    raise
+        self._flush_failed = False
+
+    def _write_one_by_one(self, records):
+        '''
+        Drops the records that fail to be written on their own
+        If none of the first `_MAX_FAILURES_IF_DOWN` ones can be written, gives up without dropping
+        anything, and returns the ones that have failed
+        '''
+        written = 0
+        failed = []
+        for record in records:
+            try:
+                self._write_batch([record])
+                written += 1
+            except:
+                failed.append(record)
+                if not written and len(failed) in (self._MAX_FAILURES_IF_DOWN, len(records)):
+                    logging.exception('Failed to write record %s, giving up' % (record, ))
+                    return failed
+        for record in failed:
+            logging.error('Dropping record %s, it can\'t be written' % (record, ))
+        self.dropped_records += len(failed)
+        return None
+
+
+class SqliteBackend(BatchingBackend):
+    '''
+    Records everything in a local SQLite database, no network hop involved
+    Supports the --strict option
+    '''
+
+    def __init__(self, path, batch_size=1000, batch_interval=1, counting=False, max_buffered=100000):
+        '''
+        `path` is the path to the database file, created if needed
+        If `counting` is True, hit counts (see `increment`) are kept in a separate table
+        See BatchingBackend for the other args
+        '''
+        self._connection = sqlite3.connect(path, timeout=60)
+        # file paths are raw bytes, and not necessarily UTF-8 (same as in snapshots)
+        self._connection.text_factory = str
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        # the primary key is also OK for likely_belongs
+        self._connection.execute('CREATE TABLE IF NOT EXISTS records (filename TEXT NOT NULL, function TEXT NOT NULL, lineno INTEGER NOT NULL, PRIMARY KEY (filename, function, lineno))')
+        # the index used for next_func
+        self._connection.execute('CREATE INDEX IF NOT EXISTS next_func_index ON records (filename, lineno, function)')
+        self._counting = counting
+        if counting:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS counts (filename TEXT NOT NULL, function TEXT NOT NULL, lineno INTEGER NOT NULL, hits INTEGER NOT NULL, PRIMARY KEY (filename, function, lineno))')
+        self._connection.commit()
+        super(SqliteBackend, self).__init__(batch_size=batch_size, batch_interval=batch_interval, max_buffered=max_buffered)
+
+    def _write_batch(self, records):
+        with self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO records (filename, function, lineno) VALUES (?, ?, ?)', records)
+
+    def likely_belongs(self, filename, function):
+        return self._connection.execute('SELECT 1 FROM records WHERE filename = ? AND function = ? LIMIT 1', (filename, function)).fetchone() is not None
+
+    def next_func(self, filename, lineno):
+        row = self._connection.execute('SELECT function FROM records WHERE filename = ? AND lineno >= ? ORDER BY lineno LIMIT 1', (filename, lineno)).fetchone()
+        return row[0] if row else None
+
+    def file_records(self, filename):
+        return self._connection.execute('SELECT lineno, function FROM records WHERE filename = ?', (filename, )).fetchall()
+
+    def iter_records(self):
+        return self._connection.execute('SELECT filename, function, lineno FROM records')
+
+    def increment(self, counts):
+        if not self._counting:
+            return
+        counts = [(filename, function, int(lineno), hits) for (filename, function, lineno), hits in counts.items()]
+        with self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO counts (filename, function, lineno, hits) VALUES (?, ?, ?, 0)',
+                                         [(filename, function, lineno) for filename, function, lineno, _ in counts])
+            self._connection.executemany('UPDATE counts SET hits = hits + ? WHERE filename = ? AND function = ? AND lineno = ?',
+                                         [(hits, filename, function, lineno) for filename, function, lineno, hits in counts])
+
+    @property
+    def counts_hits(self):
+        return self._counting
+
+    def file_counts(self, filename):
+        if not self._counting:
+            return None
+        return self._connection.execute('SELECT lineno, function, hits FROM counts WHERE filename = ?', (filename, )).fetchall()
+
+
+class SnapshotBackend(BaseBackend):
+    '''
+    A read-only backend answering from a snapshot file (see snapshot.py), for
+    analyzing without any access to the backend that recorded the data
+    Supports the --strict option if the snapshot was exported from a backend that does
+    (and, for merged snapshots, if all of them were)
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self._snapshot = Snapshot(path)
+        super(SnapshotBackend, self).__init__()
+
+    def _worker_backend_factory(self):
+        return SnapshotBackend, (self._path, )
+
+    def record(self, filename, function, lineno):
+        raise NotImplementedError('SnapshotBackend is read-only')
 
+    @property
+    def supports_strict(self):
+        return self._snapshot.line_numbers
+
+    def likely_belongs(self, filename, function):
+        return self._snapshot.likely_belongs(filename, function)
 
-class BaseMongoBackend(BaseBackend):
+    def next_func(self, filename, lineno):
+        return self._snapshot.next_func(filename, lineno)
+
+    def file_records(self, filename):
+        return self._snapshot.file_records(filename)
+
+    def iter_records(self):
+        return iter(self._snapshot)
+
+
+class BaseMongoBackend(BatchingBackend):
     '''
     A base backend for mongo - just records everything in mongo
     '''
 
-    def __init__(self, db_name, col_name, size, user='', password='', **mongo_client_kwargs):
+    # the kinds of names that can be interned
+    _FILENAME_KIND = 'fl'
+    _FUNCTION_KIND = 'fc'
+
+    def __init__(self, db_name, col_name, size, user='', password='', batch_size=1000, batch_interval=1,
+                 compact=False, compact_functions=False, aggregate=False, counting=False, max_buffered=100000, **mongo_client_kwargs):
         '''
         The size is the size of the Mongo capped collection (in bytes) - should be big enough to hold the whole thing
+        New records are buffered, and written as one unordered bulk upsert as soon as there are `batch_size`
+        of them or `batch_interval` seconds have elapsed since the last write (set `batch_size` to 1 to disable),
+        see BatchingBackend for `max_buffered`
+        If `compact` is True, file names are replaced by integer ids in the capped collection, and the mapping
+        is kept in a `<col_name>_ids` collection; `compact_functions` does the same for function names
+        Changing these settings makes the capped collection get dropped and re-created; the aggregate and
+        counts collections (see below) can't be converted though, so those then need to be dropped by hand
+        If `aggregate` is True, records also get written to a durable, deduplicated `<col_name>_aggregate`
+        collection, along with the dates they were first and last written (the daemon writes records again
+        every DEDUP_MAX_AGE seconds, so `last_seen` is accurate within that), and lookups consult both;
+        the capped collection's records also get rolled up (see `rollup`) into it before it gets re-created
+        because its size changed, so no history is lost
+        If `counting` is True, hit counts (see `increment`) are kept in a durable `<col_name>_counts` collection
         The last arg is passed as is to pymongo's MongoClient's constuctor
         (see http://api.mongodb.org/python/current/api/pymongo/mongo_client.html#pymongo.mongo_client.MongoClient)
         '''
         client = pymongo.MongoClient(**mongo_client_kwargs)
         if user:
             client[db_name].authenticate(user, password)
-        self._create_mongo_col(client, db_name, col_name, size)
+        self._compact_kinds = set()
+        if compact:
+            self._compact_kinds.add(self._FILENAME_KIND)
+        if compact_functions:
+            self._compact_kinds.add(self._FUNCTION_KIND)
+        self._aggregate_col = client[db_name]['%s_aggregate' % col_name] if aggregate else None
+        self._counts_col = client[db_name]['%s_counts' % col_name] if counting else None
+        mode_changed = self._get_compaction_mode(client[db_name][col_name]) != sorted(self._compact_kinds)
+        if mode_changed:
+            for col_object in (self._aggregate_col, self._counts_col):
+                if col_object is not None and col_object.find_one() is not None:
+                    raise ValueError('The compaction settings of %s.%s have changed, drop %s first' % (db_name, col_name, col_object.full_name))
+        if aggregate:
+            self._ensure_index(self._aggregate_col)
+            # records compacted the old way would be of no use in the aggregate collection
+            if not mode_changed and col_name in client[db_name].collection_names() and not self._check_coll_setings(client, client[db_name][col_name], size, self._compact_kinds):
+                logging.info('Rolling up %s.%s before it gets re-created' % (db_name, col_name))
+                self._rollup(client[db_name][col_name])
+        self._create_mongo_col(client, db_name, col_name, size, self._compact_kinds)
         self._mongo_col = client[db_name][col_name]
-        self._ensure_index()
-        super(BaseMongoBackend, self).__init__()
+        self._ensure_index(self._mongo_col)
+        # the collections to look records up in
+        self._lookup_cols = [self._mongo_col] if self._aggregate_col is None else [self._mongo_col, self._aggregate_col]
+        if counting:
+            self._ensure_index(self._counts_col)
+        if self._compact_kinds:
+            self._ids_col = client[db_name]['%s_ids' % col_name]
+            self._ids_col.ensure_index([('k', pymongo.ASCENDING), ('n', pymongo.ASCENDING)], name='name_index', unique=True)
+            self._ids_col.ensure_index([('k', pymongo.ASCENDING), ('i', pymongo.ASCENDING)], name='id_index', unique=True)
+            # in-memory caches of the mappings, (kind, name) => id and (kind, id) => name
+            self._ids = {}
+            self._names = {}
+        super(BaseMongoBackend, self).__init__(batch_size=batch_size, batch_interval=batch_interval, max_buffered=max_buffered)
+
+    # the key in the `<col_name>_ids` collection of the document holding the kinds of names
+    # compacted in the capped collection (collections from before compaction existed don't have one)
+    _COMPACTION_MODE_KEY = '_mode'
+
+    @staticmethod
+    def _get_compaction_mode(col_object):
+        doc = col_object.database['%s_ids' % col_object.name].find_one({'k': BaseMongoBackend._COMPACTION_MODE_KEY, 'n': ''})
+        return sorted(doc['c']) if doc else []
 
     @staticmethod
-    def _check_coll_setings(client, col_object, size):
+    def _set_compaction_mode(col_object, compact_kinds):
+        col_object.database['%s_ids' % col_object.name].update({'k': BaseMongoBackend._COMPACTION_MODE_KEY, 'n': ''},
+                                                               {'$set': {'c': sorted(compact_kinds)}}, upsert=True)
+
+    @staticmethod
+    def _check_coll_setings(client, col_object, size, compact_kinds):
         '''
         Returns true iff the settings are OK
         '''
@@ -214,11 +770,16 @@ class BaseMongoBackend(BaseBackend):
         if options.get('size', -1) != size:
             logging.debug('Capped collection does not have the right size (expected %d VS actual %d)' % (size, options.get('size', -1)))
             return False
+        # and that its names are compacted the way we expect
+        mode = BaseMongoBackend._get_compaction_mode(col_object)
+        if mode != sorted(compact_kinds):
+            logging.debug('Capped collection does not have the right compaction mode (expected %s VS actual %s)' % (sorted(compact_kinds), mode))
+            return False
         # all good!
         return True
 
     @staticmethod
-    def _create_mongo_col(client, db_name, col_name, size):
+    def _create_mongo_col(client, db_name, col_name, size, compact_kinds):
         '''
         Creates the right Mongo collection, if not present
         If it is present, it checks that it's got the right settings, otherwise it deletes it
@@ -226,25 +787,148 @@ class BaseMongoBackend(BaseBackend):
         '''
         db_object = client[db_name]
         try:
-            return db_object.create_collection(col_name, capped=True, size=size, autoIndexId=False)
+            col_object = db_object.create_collection(col_name, capped=True, size=size, autoIndexId=False)
+            BaseMongoBackend._set_compaction_mode(col_object, compact_kinds)
+            return col_object
         except pymongo.errors.CollectionInvalid:
             # the collection already exists, we check it has the right settings
             # otherwise delete it, and re-create it!
             logging.info('Checking %s.%s\'s settings' % (db_name, col_name))
-            if not BaseMongoBackend._check_coll_setings(client, db_object[col_name], size):
+            if not BaseMongoBackend._check_coll_setings(client, db_object[col_name], size, compact_kinds):
                 logging.info('Wrong settings, dropping and re-creating collection')
                 db_object.drop_collection(col_name)
-                return BaseMongoBackend._create_mongo_col(client, db_name, col_name, size)
+                return BaseMongoBackend._create_mongo_col(client, db_name, col_name, size, compact_kinds)
 
-    def _ensure_index(self):
+    def _ensure_index(self, col_object):
         '''
-        Ensures we have the right indexes on the collection
+        Ensures we have the right indexes on that collection
         '''
         raise NotImplementedError
 
-    def record(self, filename, function, lineno):
-        doc = self._build_mongo_document(filename, function, lineno)
-        self._mongo_col.update(doc, doc, upsert=True, manipulate=False, w=0, check_keys=False)
+    # how many records to roll up per bulk write
+    _ROLLUP_BATCH_SIZE = 1000
+
+    def rollup(self):
+        '''
+        Folds the capped collection into the aggregate one
+        Records written since the aggregate collection exists are already in there (see `_write_batch`),
+        that's for the older ones, and the ones written by daemons without `aggregate` set (those get
+        the date of the rollup as `first_seen`, and no `last_seen`)
+        '''
+        if self._aggregate_col is not None:
+            self._rollup(self._mongo_col)
+
+    def _rollup(self, source_col):
+        now = datetime.datetime.utcnow()
+        nb_records = 0
+        bulk = self._aggregate_col.initialize_unordered_bulk_op()
+        for doc in source_col.find(fields={'_id': False}):
+            bulk.find(doc).upsert().update_one({'$setOnInsert': {'first_seen': now}})
+            nb_records += 1
+            if nb_records % self._ROLLUP_BATCH_SIZE == 0:
+                bulk.execute()
+                bulk = self._aggregate_col.initialize_unordered_bulk_op()
+        if nb_records % self._ROLLUP_BATCH_SIZE:
+            bulk.execute()
+        logging.info('Rolled up %d records into %s' % (nb_records, self._aggregate_col.full_name))
+
+    def _intern(self, kind, name, create=True):
+        '''
+        Returns the id for that name if that kind of names is compacted, otherwise just the name
+        Returns None if it hasn't been interned yet, and `create` is False
+        '''
+        if kind not in self._compact_kinds:
+            return name
+        ident = self._ids.get((kind, name))
+        if ident is not None:
+            return ident
+        doc = self._ids_col.find_one({'k': kind, 'n': name}, fields=['i'])
+        if doc is None:
+            if not create:
+                return None
+            # there's only one counter, for all kinds of names
+            counter = self._ids_col.find_and_modify({'k': '_counter', 'n': ''}, {'$inc': {'i': 1}}, upsert=True, new=True)
+            try:
+                self._ids_col.insert({'k': kind, 'n': name, 'i': counter['i']})
+                doc = counter
+            except pymongo.errors.DuplicateKeyError:
+                # someone else interned it in the meantime
+                doc = self._ids_col.find_one({'k': kind, 'n': name}, fields=['i'])
+        self._ids[(kind, name)] = doc['i']
+        self._names[(kind, doc['i'])] = name
+        return doc['i']
+
+    def _resolve(self, kind, idents):
+        '''
+        The reverse of `_intern`, for a list of ids
+        '''
+        if kind not in self._compact_kinds:
+            return idents
+        missing = [ident for ident in set(idents) if (kind, ident) not in self._names]
+        if missing:
+            for doc in self._ids_col.find({'k': kind, 'i': {'$in': missing}}, fields=['i', 'n']):
+                self._ids[(kind, doc['n'])] = doc['i']
+                self._names[(kind, doc['i'])] = doc['n']
+        return [self._names.get((kind, ident)) for ident in idents]
+
+    def _encode(self, filename, function, create=True):
+        '''
+        Returns the (filename, function) pair as stored in the capped collection,
+        or None if either hasn't been interned yet and `create` is False
+        '''
+        filename = self._intern(self._FILENAME_KIND, filename, create=create)
+        function = self._intern(self._FUNCTION_KIND, function, create=create)
+        if filename is None or function is None:
+            return None
+        return filename, function
+
+    # the hit counts' key name
+    _HITS_KEY = 'h'
+
+    @property
+    def counts_hits(self):
+        return self._counts_col is not None
+
+    def increment(self, counts):
+        if self._counts_col is None or not counts:
+            return
+        # several records can map to the same document (e.g. without line numbers), add them up first
+        doc_hits = {}
+        for (filename, function, lineno), hits in counts.items():
+            doc = self._build_mongo_document(*(self._encode(filename, function) + (lineno, )))
+            key = tuple(sorted(doc.items()))
+            doc_hits[key] = doc_hits.get(key, 0) + hits
+        doc_hits = doc_hits.items()
+        bulk = self._counts_col.initialize_unordered_bulk_op()
+        for key, hits in doc_hits:
+            bulk.find(dict(key)).upsert().update_one({'$inc': {self._HITS_KEY: hits}})
+        try:
+            bulk.execute()
+        except pymongo.errors.BulkWriteError as ex:
+            # concurrent upserts of the same new document can collide on the unique index,
+            # but then that document exists by now
+            for error in ex.details['writeErrors']:
+                if error['code'] != 11000:
+                    raise
+                key, hits = doc_hits[error['index']]
+                self._counts_col.update(dict(key), {'$inc': {self._HITS_KEY: hits}}, upsert=True)
+
+    def _write_batch(self, records):
+        docs = [self._build_mongo_document(*(self._encode(filename, function) + (lineno, ))) for filename, function, lineno in records]
+        if len(docs) == 1:
+            self._mongo_col.update(docs[0], docs[0], upsert=True, manipulate=False, w=0, check_keys=False)
+        else:
+            bulk = self._mongo_col.initialize_unordered_bulk_op()
+            for doc in docs:
+                bulk.find(doc).upsert().replace_one(doc)
+            bulk.execute({'w': 0})
+        if self._aggregate_col is not None:
+            # unlike the capped collection, that one can have its documents grow
+            now = datetime.datetime.utcnow()
+            bulk = self._aggregate_col.initialize_unordered_bulk_op()
+            for doc in docs:
+                bulk.find(doc).upsert().update_one({'$max': {'last_seen': now}, '$setOnInsert': {'first_seen': now}})
+            bulk.execute({'w': 0})
 
 
 class StrictMongoBackend(BaseMongoBackend):
@@ -258,25 +942,63 @@ class StrictMongoBackend(BaseMongoBackend):
     _FUNCTION_KEY = 'fc'
     _LINENO_KEY = 'l'
 
-    def _ensure_index(self):
+    def _ensure_index(self, col_object):
         # the main index, also OK for likely_belongs
-        self._mongo_col.ensure_index([(key, pymongo.ASCENDING) for key in (self._FILENAME_KEY, self._FUNCTION_KEY, self._LINENO_KEY)], name='main_index', unique=True, dropDups=True)
+        col_object.ensure_index([(key, pymongo.ASCENDING) for key in (self._FILENAME_KEY, self._FUNCTION_KEY, self._LINENO_KEY)], name='main_index', unique=True, dropDups=True)
         # the index used for next_func
-        self._mongo_col.ensure_index([(key, pymongo.ASCENDING) for key in (self._FILENAME_KEY, self._LINENO_KEY, self._FUNCTION_KEY)], name='next_func_index')
+        col_object.ensure_index([(key, pymongo.ASCENDING) for key in (self._FILENAME_KEY, self._LINENO_KEY, self._FUNCTION_KEY)], name='next_func_index')
 
     def _build_mongo_document(self, filename, function, lineno):
         return {self._FILENAME_KEY: filename, self._FUNCTION_KEY: function, self._LINENO_KEY: int(lineno)}
 
     def likely_belongs(self, filename, function):
-        return self._mongo_col.find_one({self._FILENAME_KEY: filename, self._FUNCTION_KEY: function}, fields=[]) is not None
+        encoded = self._encode(filename, function, create=False)
+        if encoded is None:
+            return False
+        filename, function = encoded
+        return any(col_object.find_one({self._FILENAME_KEY: filename, self._FUNCTION_KEY: function}, fields=[]) is not None for col_object in self._lookup_cols)
 
     def next_func(self, filename, lineno):
-        try:
-            record = self._mongo_col.find({self._FILENAME_KEY: filename, self._LINENO_KEY: {'$gte': lineno}}, fields=[self._FUNCTION_KEY]).sort(self._LINENO_KEY).limit(1).next()
-            return record[self._FUNCTION_KEY]
-        except StopIteration:
-            # no such record found
+        filename = self._intern(self._FILENAME_KIND, filename, create=False)
+        if filename is None:
+            return None
+        records = []
+        for col_object in self._lookup_cols:
+            try:
+                records.append(col_object.find({self._FILENAME_KEY: filename, self._LINENO_KEY: {'$gte': lineno}}, fields=[self._FUNCTION_KEY, self._LINENO_KEY]).sort(self._LINENO_KEY).limit(1).next())
+            except StopIteration:
+                # no such record found
+                pass
+        if not records:
             return None
+        record = min(records, key=lambda record: record[self._LINENO_KEY])
+        return self._resolve(self._FUNCTION_KIND, [record[self._FUNCTION_KEY]])[0]
+
+    def file_records(self, filename):
+        filename = self._intern(self._FILENAME_KIND, filename, create=False)
+        if filename is None:
+            return []
+        # that uses main_index's prefix
+        records = [record for col_object in self._lookup_cols for record in col_object.find({self._FILENAME_KEY: filename}, fields=[self._FUNCTION_KEY, self._LINENO_KEY])]
+        functions = self._resolve(self._FUNCTION_KIND, [record[self._FUNCTION_KEY] for record in records])
+        return [(record[self._LINENO_KEY], function) for record, function in zip(records, functions)]
+
+    def file_counts(self, filename):
+        if self._counts_col is None:
+            return None
+        filename = self._intern(self._FILENAME_KIND, filename, create=False)
+        if filename is None:
+            return []
+        records = list(self._counts_col.find({self._FILENAME_KEY: filename}, fields=[self._FUNCTION_KEY, self._LINENO_KEY, self._HITS_KEY]))
+        functions = self._resolve(self._FUNCTION_KIND, [record[self._FUNCTION_KEY] for record in records])
+        return [(record[self._LINENO_KEY], function, record[self._HITS_KEY]) for record, function in zip(records, functions)]
+
+    def iter_records(self):
+        for col_object in self._lookup_cols:
+            for record in col_object.find(fields={'_id': False}):
+                filename = self._resolve(self._FILENAME_KIND, [record[self._FILENAME_KEY]])[0]
+                function = self._resolve(self._FUNCTION_KIND, [record[self._FUNCTION_KEY]])[0]
+                yield filename, function, record[self._LINENO_KEY]
 
 
 class LooseMongoBackend(BaseMongoBackend):
@@ -287,18 +1009,92 @@ class LooseMongoBackend(BaseMongoBackend):
 
     _KEY_NAME = 'l'
 
-    def _ensure_index(self):
-        self._mongo_col.ensure_index(self._KEY_NAME, name='zomphp_index', unique=True, dropDups=True)
+    def _ensure_index(self, col_object):
+        col_object.ensure_index(self._KEY_NAME, name='zomphp_index', unique=True, dropDups=True)
 
     def _build_mongo_document(self, filename, function, lineno):
         return {self._KEY_NAME: '%s:%s' % (filename, function)}
 
     def likely_belongs(self, filename, function):
-        return self._mongo_col.find_one(self._build_mongo_document(filename, function, 0), fields=[]) is not None
+        encoded = self._encode(filename, function, create=False)
+        if encoded is None:
+            return False
+        doc = self._build_mongo_document(encoded[0], encoded[1], 0)
+        return any(col_object.find_one(doc, fields=[]) is not None for col_object in self._lookup_cols)
 
-    def next_func(self):
+    @property
+    def supports_strict(self):
+        return False
+
+    def next_func(self, filename, lineno):
         raise NotImplementedError('LooseMongoBackend does not support the \'--strict\' option!')
 
+    def _find_file_records(self, col_objects, filename, fields):
+        '''
+        Returns the records for that file in those collections, along with their function names
+        '''
+        # an anchored regex can use the index
+        filename = self._intern(self._FILENAME_KIND, filename, create=False)
+        if filename is None:
+            return [], []
+        prefix = '%s:' % filename
+        query = {self._KEY_NAME: {'$regex': '^%s' % re.escape(prefix)}}
+        records = [record for col_object in col_objects for record in col_object.find(query, fields=fields)]
+        functions = [record[self._KEY_NAME][len(prefix):] for record in records]
+        if self._FUNCTION_KIND in self._compact_kinds:
+            functions = self._resolve(self._FUNCTION_KIND, [int(function) for function in functions])
+        return records, functions
+
+    def file_records(self, filename):
+        # we don't know about line numbers, see `supports_strict`
+        _, functions = self._find_file_records(self._lookup_cols, filename, [self._KEY_NAME])
+        return [(0, function) for function in functions]
+
+    def file_counts(self, filename):
+        if self._counts_col is None:
+            return None
+        records, functions = self._find_file_records([self._counts_col], filename, [self._KEY_NAME, self._HITS_KEY])
+        return [(0, function, record[self._HITS_KEY]) for record, function in zip(records, functions)]
+
+    def iter_records(self):
+        for col_object in self._lookup_cols:
+            for record in col_object.find(fields={'_id': False}):
+                filename, _, function = record[self._KEY_NAME].rpartition(':')
+                if self._FILENAME_KIND in self._compact_kinds:
+                    filename = self._resolve(self._FILENAME_KIND, [int(filename)])[0]
+                if self._FUNCTION_KIND in self._compact_kinds:
+                    function = self._resolve(self._FUNCTION_KIND, [int(function)])[0]
+                yield filename, function, 0
+
+
+# the backend of the current worker process, when processing directories with several jobs
+_worker_backend = None
+_worker_options = None
+
+
+def _init_worker(backend_factory, strict, translator, start_date, report, profile, min_hits):
+    global _worker_backend, _worker_options
+    new_backend, args = backend_factory
+    _worker_backend = new_backend(*args)
+    if profile:
+        _worker_backend.profiler = Profiler()
+    _worker_options = {'strict': strict, 'translator': translator, 'start_date': start_date, 'report': report, 'min_hits': min_hits}
+    # stop that worker's extractor process when the pool shuts down
+    multiprocessing.util.Finalize(_worker_backend, _worker_backend.close, exitpriority=10)
+
+
+def _process_file_in_worker(path):
+    '''
+    Returns how much that file added to the worker backend's counters,
+    the entries to report if reporting, and the profiling data if profiling
+    '''
+    options = dict(_worker_options)
+    reporter = CollectingReporter() if options.pop('report') else None
+    before = _worker_backend._counters
+    _worker_backend._do_process_file(path, reporter=reporter, **options)
+    counters = tuple(after - previous for after, previous in zip(_worker_backend._counters, before))
+    return counters, reporter.entries if reporter is not None else [], _worker_backend.profiler.pop_data()
+
 
 def get_new_backend():
     '''
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import argparse
+import subprocess
+import multiprocessing
+
+import wire
+
+ZOMPHP_DIR = os.path.dirname(os.path.abspath(__file__))
+DAEMON_EXEC = os.path.join(ZOMPHP_DIR, 'daemon.py')
+ZOMPHP_EXEC = os.path.join(ZOMPHP_DIR, 'zomphp.py')
+
+
+class BenchEnvironment(object):
+    '''
+    A temporary directory holding a settings file that points to a local SQLite backend,
+    so that benchmarks run offline and never touch the real settings or backend
+    '''
+
+    def __init__(self, keep=False, **settings):
+        # PHP unrolls symlinks, so must we
+        self.work_dir = os.path.realpath(tempfile.mkdtemp(prefix='zomphp_bench.'))
+        self.db_path = os.path.join(self.work_dir, 'bench.sqlite')
+        self._keep = keep
+        all_settings = {'BACKEND_CLASS_NAME': 'SqliteBackend',
+                        'BACKEND_KWARGS': {'path': self.db_path},
+                        'EXTRACTION_CACHE_DIR': os.path.join(self.work_dir, 'cache'),
+                        'LOG_FILE': os.path.join(self.work_dir, 'zomphp.log'),
+                        'LOG_LEVEL': 'WARNING',
+                        'ZOMPHP_DEAMON_OWNER': None}
+        all_settings.update(settings)
+        with open(os.path.join(self.work_dir, 'zomphp_settings.py'), 'w') as settings_file:
+            for name, value in sorted(all_settings.items()):
+                settings_file.write('%s = %r\n' % (name, value))
+        # for the modules we import from here...
+        sys.path.insert(0, self.work_dir)
+        # ... and for the processes we spawn
+        self.env = dict(os.environ)
+        self.env['PYTHONPATH'] = os.pathsep.join(filter(None, [self.work_dir, self.env.get('PYTHONPATH')]))
+
+    def cleanup(self):
+        if self._keep:
+            print >> sys.stderr, 'Leaving the bench files in %s' % self.work_dir
+        else:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def percentiles(values, scale=1000):
+    '''
+    Summarizes a list of durations (in seconds, reported in milliseconds by default)
+    '''
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {'p%d' % p: values[min(len(values) - 1, len(values) * p // 100)] * scale for p in (50, 90, 99)}
+    result['max'] = values[-1] * scale
+    result['mean'] = sum(values) * scale / len(values)
+    return result
+
+
+def synthetic_records(nb_files, nb_functions, seed):
+    '''
+    Returns a list of (filename, function, lineno) triples, spread over that many files
+    '''
+    rnd = random.Random(seed)
+    records = []
+    for file_nb in xrange(nb_files):
+        filename = '/srv/app/src/module%d/File%d.php' % (file_nb % 50, file_nb)
+        lineno = 1
+        for function_nb in xrange(nb_functions):
+            lineno += rnd.randint(3, 40)
+            records.append((filename, 'function%d' % function_nb, lineno))
+    return records
+
+
+###################
+# Ingestion bench #
+###################
+
+def _run_client(params):
+    '''
+    Writes records to the daemon's socket, the way PHP processes do,
+    and returns the latencies of the writes
+    '''
+    socket_path, records, nb_records, skew, framed, seed = params
+    rnd = random.Random(seed)
+    encoder = wire.FramedEncoder() if framed else None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    latencies = []
+    for _ in xrange(nb_records):
+        # the higher the skew, the more the first records are sent
+        record = records[int(len(records) * rnd.random() ** skew)]
+        start = time.time()
+        client.sendall(encoder.encode([record]) if framed else '%s:%s:%d\n' % record)
+        latencies.append(time.time() - start)
+    client.close()
+    return latencies
+
+
+def _wait_for(predicate, timeout, what):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise RuntimeError('Timed out waiting for %s' % what)
+        time.sleep(0.05)
+
+
+def bench_ingest(args):
+    environment = BenchEnvironment(keep=args.keep,
+                                   DAEMON_WORKERS=args.workers,
+                                   DEDUP_CACHE_SIZE=args.dedup_cache_size,
+                                   WRITE_QUEUE_OVERFLOW_POLICY=args.overflow_policy)
+    # only importable now that the settings are set
+    from daemon import send_control_command
+
+    socket_path = os.path.join(environment.work_dir, 'zomphp.socket')
+    control_socket_path = '%s.control' % socket_path
+    daemon = subprocess.Popen([sys.executable, DAEMON_EXEC, '--socket-path', socket_path], env=environment.env)
+    try:
+        _wait_for(lambda: os.path.exists(socket_path), 30, 'the daemon to start')
+        # the control sockets come up right after the main one
+        _wait_for(lambda: len(send_control_command('stats', control_socket_path)) >= args.workers, 30, 'the daemon to start')
+
+        records = synthetic_records(args.files, args.functions, args.seed)
+        nb_records = args.clients * args.records
+        pool = multiprocessing.Pool(args.clients)
+        start = time.time()
+        latencies = pool.map(_run_client, [(socket_path, records, args.records, args.skew, args.framed, args.seed + i) for i in range(args.clients)])
+        clients_time = time.time() - start
+        pool.close()
+        pool.join()
+
+        def drained():
+            stats = send_control_command('stats', control_socket_path).values()
+            return sum(s.get('lines_received', 0) for s in stats) >= nb_records and all(s.get('writer', {}).get('queued') == 0 for s in stats)
+        _wait_for(drained, args.timeout, 'the daemon to process all records')
+        drain_time = time.time() - start
+        daemon_stats = send_control_command('stats', control_socket_path)
+    finally:
+        daemon.send_signal(signal.SIGTERM)
+        daemon.wait()
+        environment.cleanup()
+
+    return {'records': nb_records,
+            'distinct_records': len(records),
+            'framed': args.framed,
+            'clients': args.clients,
+            'daemon_workers': args.workers,
+            'clients_seconds': clients_time,
+            'clients_throughput': nb_records / clients_time,
+            'sustained_seconds': drain_time,
+            'sustained_throughput': nb_records / drain_time,
+            'write_latency_ms': percentiles([latency for client_latencies in latencies for latency in client_latencies]),
+            'daemon_stats': daemon_stats}
+
+
+##################
+# Analysis bench #
+##################
+
+def generate_tree(root, nb_files, nb_functions, seed):
+    '''
+    Generates a tree of PHP files, each defining that many functions,
+    and returns the (filename, function, lineno) triples for all of them
+    '''
+    rnd = random.Random(seed)
+    functions = []
+    for file_nb in xrange(nb_files):
+        directory = os.path.join(root, 'module%d' % (file_nb % 50))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, 'File%d.php' % file_nb)
+        lines = ['<?php', '', 'class File%d' % file_nb, '{']
+        for function_nb in xrange(nb_functions):
+            functions.append((path, 'method%d' % function_nb, len(lines) + 1))
+            lines.append('    public function method%d($arg)' % function_nb)
+            lines.append('    {')
+            lines.extend('        $arg = $arg * %d;' % rnd.randint(1, 100) for _ in xrange(rnd.randint(1, 20)))
+            lines.append('        return $arg;')
+            lines.append('    }')
+            lines.append('')
+        lines.append('}')
+        with open(path, 'w') as php_file:
+            php_file.write('\n'.join(lines) + '\n')
+    return functions
+
+
+def _profile_run(command, env, profile_path):
+    '''
+    Returns how long that zomphp.py run took, start-up included, and its --profile summary
+    '''
+    start = time.time()
+    subprocess.check_call(command + ['--profile', profile_path], env=env)
+    seconds = time.time() - start
+    with open(profile_path) as profile_file:
+        return seconds, json.load(profile_file)
+
+
+def bench_analyze(args):
+    environment = BenchEnvironment(keep=args.keep)
+    # only importable now that the settings are set
+    import backend
+
+    phases = {}
+    profiles = {}
+    try:
+        root = os.path.join(environment.work_dir, 'tree')
+        start = time.time()
+        functions = generate_tree(root, args.files, args.functions, args.seed)
+        phases['generate'] = time.time() - start
+
+        start = time.time()
+        rnd = random.Random(args.seed)
+        local_backend = backend.SqliteBackend(environment.db_path)
+        for function in functions:
+            if rnd.random() < args.used_ratio:
+                local_backend.record(*function)
+        local_backend.close()
+        phases['record'] = time.time() - start
+
+        # report mode leaves the files untouched...
+        command = [sys.executable, ZOMPHP_EXEC, '--dir', root, '--jobs', str(args.jobs), '--report', 'ndjson',
+                   '--report-file', os.path.join(environment.work_dir, 'report.ndjson')]
+        profile_path = os.path.join(environment.work_dir, 'profile.json')
+        # ... so while the first run parses everything...
+        phases['analyze_cold'], profiles['analyze_cold'] = _profile_run(command, environment.env, profile_path)
+        # ... the second one only hits the extraction cache
+        phases['analyze_warm'], profiles['analyze_warm'] = _profile_run(command, environment.env, profile_path)
+    finally:
+        environment.cleanup()
+
+    return {'files': args.files,
+            'functions': len(functions),
+            'jobs': args.jobs,
+            'phases_seconds': phases,
+            'analyze_profiles': profiles}
+
+
+def main():
+    # argument processing
+    parser = argparse.ArgumentParser(description='Benchmarks ZomPHP against a local SQLite backend')
+    parser.add_argument('--seed', dest='seed', type=int, default=42,
+                        help='The seed for the synthetic data')
+    parser.add_argument('--keep', dest='keep', action='store_const',
+                        const=True, default=False, help='Don\'t delete the '
+                        'bench\'s temporary files')
+    subparsers = parser.add_subparsers()
+
+    ingest = subparsers.add_parser('ingest', help='Floods a daemon with '
+                                   'synthetic records from concurrent clients')
+    ingest.set_defaults(bench=bench_ingest)
+    ingest.add_argument('--clients', dest='clients', type=int, default=8,
+                        help='The number of concurrent clients')
+    ingest.add_argument('--records', dest='records', type=int, default=100000,
+                        help='The number of records each client sends')
+    ingest.add_argument('--files', dest='files', type=int, default=1000,
+                        help='The number of distinct files in the records')
+    ingest.add_argument('--functions', dest='functions', type=int, default=10,
+                        help='The number of distinct functions per file')
+    ingest.add_argument('--skew', dest='skew', type=float, default=3,
+                        help='How skewed the mix of records is (1 is uniform, '
+                        'the higher the fewer records make most of the traffic)')
+    ingest.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='The number of daemon workers')
+    ingest.add_argument('--dedup-cache-size', dest='dedup_cache_size',
+                        type=int, default=100000, help='The size of the '
+                        'daemon\'s dedup cache (0 disables it)')
+    ingest.add_argument('--overflow-policy', dest='overflow_policy', type=str,
+                        default='block', help='The daemon\'s write queue '
+                        'overflow policy')
+    ingest.add_argument('--framed', dest='framed', action='store_const',
+                        const=True, default=False, help='Use the framed '
+                        'protocol instead of the text one')
+    ingest.add_argument('--timeout', dest='timeout', type=int, default=600,
+                        help='How long to wait for the daemon to process '
+                        'all records, in seconds')
+
+    analyze = subparsers.add_parser('analyze', help='Profiles zomphp.py --dir '
+                                    'on a synthetic PHP tree')
+    analyze.set_defaults(bench=bench_analyze)
+    analyze.add_argument('--files', dest='files', type=int, default=1000,
+                         help='The number of PHP files to generate')
+    analyze.add_argument('--functions', dest='functions', type=int, default=20,
+                         help='The number of functions in each file')
+    analyze.add_argument('--used-ratio', dest='used_ratio', type=float,
+                         default=0.8, help='The ratio of functions recorded '
+                         'as used')
+    analyze.add_argument('--jobs', dest='jobs', type=int, default=1,
+                         help='Passed to zomphp.py')
+    args = parser.parse_args()
+
+    print json.dumps(args.bench(args), indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,3 +8,7 @@
 # must have r+w+x access for both the user running ZomPHP and the users running the PHP processes
 # (777 works great, and it's normally the default for /tmp)
 SOCKET_PATH = '/tmp/zomphp.socket'
+
+# the path to ZomPHP's control socket, to get the daemon's stats and change its log level
+# (when running several workers, each of them listens on that path suffixed with its number)
+CONTROL_SOCKET_PATH = '/tmp/zomphp.control.socket'
@@ -5,47 +5,580 @@ import os
 import sys
 import logging
 import argparse
-from twisted.internet import reactor, protocol
+import threading
+import time
+import Queue
+import collections
+import socket
+import signal
+import errno
+import json
+import glob
+# don't import the reactor here: when running several workers, each
+# of them must install its own after forking
+from twisted.internet import protocol, task
+from twisted.protocols import basic
 
 if os.path.exists('/etc/zomphp/zomphp_settings.py'):
     sys.path.append('/etc/zomphp')
 
-from utils import set_logger
+from utils import set_logger, get_setting, SeenCache, LatencyHistogram, PathCanonicalizer
 from zomphp_settings import ZOMPHP_DEAMON_OWNER
-from constants import SOCKET_PATH
+from constants import SOCKET_PATH, CONTROL_SOCKET_PATH
 from backend import get_new_backend
+import wire
+
+
+class BackendWriter(threading.Thread):
+    '''
+    Feeds the backend from its own thread, through a bounded queue, so that the reactor
+    never has to wait on the backend
+    When the queue is full, depending on the overflow policy, we either drop the oldest
+    queued item, drop the new one, or block until there's room
+    Hit counts (see `put_hits`) are kept apart, in an unbounded queue: there's only one batch of
+    them per HIT_COUNT_INTERVAL, and they're never dropped
+    The backend gets created in that thread, as some backends can't be shared across threads
+    If set, `on_lost` gets called with every item that's dropped, or that fails to be written,
+    from whichever thread that happens in
+    '''
+
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEW = 'drop_new'
+    BLOCK = 'block'
+
+    # put on the queue to make the thread stop
+    _STOP = object()
+
+    def __init__(self, max_size, overflow_policy, flush_interval):
+        if overflow_policy not in (self.DROP_OLDEST, self.DROP_NEW, self.BLOCK):
+            raise ValueError('Unknown overflow policy: %s' % overflow_policy)
+        super(BackendWriter, self).__init__(name='BackendWriter')
+        self.daemon = True
+        self._queue = Queue.Queue(max_size)
+        # deques are thread-safe, and never block
+        self._hits_queue = collections.deque()
+        self._overflow_policy = overflow_policy
+        self._flush_interval = flush_interval
+        self._ready = threading.Event()
+        self._backend = None
+        self._canonicalizer = PathCanonicalizer.build_canonicalizer()
+        self.on_lost = None
+        self.dropped = 0
+        self.written = 0
+        self.hits_written = 0
+        self.errors = 0
+        self._record_latency = LatencyHistogram()
+        self._flush_latency = LatencyHistogram()
+
+    def put(self, item):
+        if self._overflow_policy == self.BLOCK:
+            self._queue.put(item)
+            return
+        try:
+            self._queue.put_nowait(item)
+            return
+        except Queue.Full:
+            pass
+        self.dropped += 1
+        if self._overflow_policy == self.DROP_OLDEST:
+            try:
+                oldest = self._queue.get_nowait()
+            except Queue.Empty:
+                oldest = None
+            # only the reactor's thread puts items, so there's room now
+            self._queue.put_nowait(item)
+            item = oldest
+        if item is not None:
+            self._lost(item)
+
+    def _lost(self, item):
+        if self.on_lost is not None:
+            self.on_lost(item)
+
+    def put_hits(self, hits):
+        '''
+        `hits` is a dict mapping items (see `ZomPHPServerFactory.report_items`) to numbers of calls
+        Written out by the thread within FLUSH_INTERVAL
+        '''
+        self._hits_queue.append(hits)
+
+    def start(self):
+        '''
+        Starts the thread, and waits until the backend is initialized
+        '''
+        super(BackendWriter, self).start()
+        self._ready.wait()
+        if self._backend is None:
+            raise RuntimeError('Could not initialize the backend')
+
+    def stop(self):
+        '''
+        Writes out whatever is left in the queue, then stops the thread
+        '''
+        self._queue.put(self._STOP)
+        self.join()
+
+    def run(self):
+        try:
+            self._backend = get_new_backend()
+        except:
+            logging.exception('Failed to initialize the backend')
+            return
+        finally:
+            self._ready.set()
+        last_flush = time.time()
+        while True:
+            try:
+                item = self._queue.get(timeout=self._flush_interval)
+            except Queue.Empty:
+                item = None
+            if item is self._STOP:
+                break
+            if item is not None:
+                start = time.time()
+                try:
+                    self._write(item)
+                    self.written += 1
+                except:
+                    self.errors += 1
+                    logging.exception('Failed to write %s to the backend' % (item, ))
+                    self._lost(item)
+                self._record_latency.add(time.time() - start)
+            # make sure buffered records get written out even when traffic is low
+            if time.time() - last_flush >= self._flush_interval:
+                self._write_pending_hits()
+                self._flush()
+                last_flush = time.time()
+        self._write_pending_hits()
+        self._flush()
+
+    def _write_pending_hits(self):
+        while self._hits_queue:
+            hits = self._hits_queue.popleft()
+            try:
+                self._write_hits(hits)
+                self.hits_written += len(hits)
+            except:
+                self.errors += 1
+                logging.exception('Failed to write %d hit counts to the backend' % len(hits))
+
+    def _write(self, item):
+        if self._canonicalizer is None and not isinstance(item, tuple):
+            self._backend.process_raw_data(item)
+            return
+        self._backend.record(*self._parse(item))
+
+    def _parse(self, item):
+        '''
+        Returns the (filename, function, lineno) tuple for that item, with the path canonicalized
+        '''
+        # tuples are already parsed, from the framed protocol
+        filename, function, lineno = item if isinstance(item, tuple) else self._backend.parse_raw_data(item)
+        if self._canonicalizer is not None:
+            filename = self._canonicalizer.translate(filename)
+        return filename, function, int(lineno)
+
+    def _write_hits(self, hits):
+        counts = {}
+        for item, item_hits in hits.items():
+            try:
+                record = self._parse(item)
+            except ValueError:
+                # e.g. a partial line left over when a connection got closed
+                self.errors += 1
+                logging.error('Ignoring the hit count for malformed record %s' % (item, ))
+                continue
+            # different items can end up being the same record once canonicalized
+            counts[record] = counts.get(record, 0) + item_hits
+        self._backend.increment(counts)
+
+    def _flush(self):
+        start = time.time()
+        try:
+            self._backend.flush()
+        except:
+            self.errors += 1
+            logging.exception('Failed to flush the backend')
+        self._flush_latency.add(time.time() - start)
+
+    @property
+    def counts_hits(self):
+        return self._backend.counts_hits
+
+    @property
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'queued_hit_batches': len(self._hits_queue), 'dropped': self.dropped, 'written': self.written, 'hits_written': self.hits_written, 'errors': self.errors,
+                'backend_dropped': self._backend.dropped_records if self._backend is not None else 0,
+                'record_latency': self._record_latency.stats, 'flush_latency': self._flush_latency.stats}
+
+
+class RollupThread(threading.Thread):
+    '''
+    Periodically calls the backend's `rollup`, with its own backend object
+    '''
+
+    def __init__(self, interval):
+        super(RollupThread, self).__init__(name='RollupThread')
+        self.daemon = True
+        self._interval = interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        backend = None
+        while not self._stopping.wait(self._interval):
+            try:
+                if backend is None:
+                    backend = get_new_backend()
+                backend.rollup()
+            except:
+                logging.exception('Failed to roll up the backend')
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
 
 
 class ZomPHPServer(protocol.Protocol):
+    '''
+    Speaks either the text or the framed protocol (see wire.py),
+    depending on how the connection starts
+    '''
+
     def __init__(self, factory):
         logging.debug('Starting new server')
         self._factory = factory
+        self._decoder = None
+
+    def connectionMade(self):
+        self._factory.connections.add(self)
 
     def dataReceived(self, data):
-        self._factory.report_data(data)
+        if self._factory.closed:
+            # shutting down, the writer's gone
+            return
+        self._factory.bytes_read += len(data)
+        if self._decoder is None:
+            self._decoder = wire.new_decoder(data)
+        try:
+            self._factory.report_items(self._decoder.feed(data))
+        except wire.ProtocolError as ex:
+            logging.error('Closing connection: %s' % ex)
+            self._factory.protocol_errors += 1
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self._factory.connections.discard(self)
+        self._close_decoder()
+
+    def close(self):
+        '''
+        Reports whatever's left right away, then closes the connection
+        '''
+        self._close_decoder()
+        self.transport.loseConnection()
+
+    def _close_decoder(self):
+        if self._decoder is not None:
+            self._factory.report_items(self._decoder.close())
+            self._factory.decoding_errors += self._decoder.errors
+            self._decoder = None
 
 
 class ZomPHPServerFactory(protocol.Factory):
-    def __init__(self):
+    # how often (in seconds) we compute the rates reported in the stats
+    _RATE_INTERVAL = 10
+
+    def __init__(self, writer, state_path=None, counting=False):
+        '''
+        If given a state path, the dedup cache gets re-loaded from there, and saved there on shutdown
+        If `counting` is True, calls get counted in memory until `flush_hits` sends them to the writer
+        '''
         logging.debug('Initializing new factory')
-        self._backend = get_new_backend()
+        self._writer = writer
+        self._start_time = time.time()
+        self.lines_received = 0
+        self.bytes_read = 0
+        self.protocol_errors = 0
+        self.decoding_errors = 0
+        self._rates = {}
+        self._last_sample = None
+        cache_size = get_setting('DEDUP_CACHE_SIZE', 0)
+        self._cache = SeenCache(cache_size, max_age=get_setting('DEDUP_MAX_AGE', 3600)) if cache_size else None
+        self._state_path = state_path if self._cache is not None else None
+        if self._cache is not None:
+            # so that they get sent again next time
+            writer.on_lost = self._forget
+        # item => number of calls since the last flush
+        self._hits = {} if counting else None
+        # the open connections
+        self.connections = set()
+        # set once the open connections have been closed, on shutdown
+        self.closed = False
+        if self._state_path and os.path.exists(self._state_path):
+            try:
+                self._cache.load(self._state_path)
+                logging.info('Loaded %d entries from %s' % (len(self._cache), self._state_path))
+            except:
+                logging.exception('Failed to load the state from %s, starting from scratch' % self._state_path)
 
     def buildProtocol(self, addr):
         return ZomPHPServer(self)
 
-    def report_data(self, data):
-        for item in data.split('\n'):
-            if item:
-                self._backend.process_raw_data(item)
+    def report_items(self, items):
+        '''
+        Items are either raw records as strings, or (filename, function, lineno) tuples
+        '''
+        for item in items:
+            self.lines_received += 1
+            # count before deduping, that's the whole point
+            if self._hits is not None:
+                self._hits[item] = self._hits.get(item, 0) + 1
+            if self._cache is None or not self._cache.seen(item):
+                self._writer.put(item)
+
+    def close_connections(self):
+        '''
+        Closes all the open connections, reporting whatever they have left, and stops reporting anything else
+        '''
+        for connection in list(self.connections):
+            connection.close()
+        self.closed = True
+
+    def _forget(self, item):
+        '''
+        Removes an item that didn't make it to the backend from the dedup cache; called by the writer,
+        possibly from its own thread
+        '''
+        if self.closed:
+            # the reactor's thread is only waiting for the writer to stop, and the state is about to be saved
+            self._cache.discard(item)
+            return
+        from twisted.internet import reactor
+        reactor.callFromThread(self._cache.discard, item)
+
+    def flush_hits(self):
+        if self._hits:
+            hits, self._hits = self._hits, {}
+            self._writer.put_hits(hits)
+
+    def save_state(self):
+        if not self._state_path:
+            return
+        try:
+            self._cache.save(self._state_path)
+            logging.info('Saved %d entries to %s' % (len(self._cache), self._state_path))
+        except:
+            logging.exception('Failed to save the state to %s' % self._state_path)
+
+    def sample_rates(self):
+        sample = (time.time(), self.lines_received, self._writer.written)
+        if self._last_sample is not None:
+            elapsed = sample[0] - self._last_sample[0]
+            self._rates = {'lines_per_second': (sample[1] - self._last_sample[1]) / elapsed,
+                           'records_per_second': (sample[2] - self._last_sample[2]) / elapsed}
+        self._last_sample = sample
+
+    @property
+    def stats(self):
+        stats = {'pid': os.getpid(),
+                 'uptime': time.time() - self._start_time,
+                 'lines_received': self.lines_received,
+                 'bytes_read': self.bytes_read,
+                 'protocol_errors': self.protocol_errors,
+                 'decoding_errors': self.decoding_errors,
+                 'dedup_cache': self._cache.stats if self._cache is not None else None,
+                 'pending_hits': len(self._hits) if self._hits is not None else None,
+                 'writer': self._writer.stats}
+        stats.update(self._rates)
+        return stats
+
+
+class ZomPHPControlProtocol(basic.LineReceiver):
+    '''
+    Answers the commands sent on the control socket, one per line, with one line of JSON:
+     * `stats` returns the daemon's counters
+     * `log_level LEVEL` changes the log level
+    '''
+
+    delimiter = '\n'
+
+    def lineReceived(self, line):
+        command, _, arg = line.strip().partition(' ')
+        if command == 'stats':
+            response = self.factory.server_factory.stats
+        elif command == 'log_level':
+            level = arg.strip().upper()
+            if isinstance(getattr(logging, level, None), int):
+                logging.getLogger().setLevel(getattr(logging, level))
+                logging.info('Log level changed to %s' % level)
+                response = {'log_level': level}
+            else:
+                response = {'error': 'Unknown log level: %s' % arg}
+        else:
+            response = {'error': 'Unknown command: %s' % command}
+        self.sendLine(json.dumps(response))
+
+
+class ZomPHPControlFactory(protocol.Factory):
+    protocol = ZomPHPControlProtocol
+
+    def __init__(self, server_factory):
+        self.server_factory = server_factory
 
 
 class ZomPHPDaemon(object):
 
-    def run(self):
-        factory = ZomPHPServerFactory()
-        reactor.listenUNIX(SOCKET_PATH, factory)
+    def __init__(self, socket_path=SOCKET_PATH, control_socket_path=CONTROL_SOCKET_PATH):
+        self._socket_path = socket_path
+        self._control_socket_path = control_socket_path
+
+    def run(self, listening_socket=None, worker_number=None):
+        '''
+        If given a listening socket, accepts connections on that one instead of opening the socket path
+        '''
+        from twisted.internet import reactor
+        writer = BackendWriter(get_setting('WRITE_QUEUE_SIZE', 100000),
+                               get_setting('WRITE_QUEUE_OVERFLOW_POLICY', BackendWriter.DROP_OLDEST),
+                               get_setting('FLUSH_INTERVAL', 1))
+        writer.start()
+        state_path = get_setting('STATE_FILE')
+        if state_path and worker_number is not None:
+            state_path = '%s.%d' % (state_path, worker_number)
+        hit_count_interval = get_setting('HIT_COUNT_INTERVAL')
+        if hit_count_interval and not writer.counts_hits:
+            logging.warning('Ignoring HIT_COUNT_INTERVAL, the backend does not count hits')
+            hit_count_interval = None
+        factory = ZomPHPServerFactory(writer, state_path=state_path, counting=bool(hit_count_interval))
+        if listening_socket is None:
+            port = reactor.listenUNIX(self._socket_path, factory)
+        else:
+            port = reactor.adoptStreamPort(listening_socket.fileno(), socket.AF_UNIX, factory)
+        control_socket_path = self._control_socket_path if worker_number is None else '%s.%d' % (self._control_socket_path, worker_number)
+        if os.path.exists(control_socket_path):
+            os.remove(control_socket_path)
+        # only for the daemon's owner (and root), PHP processes have nothing to do there
+        reactor.listenUNIX(control_socket_path, ZomPHPControlFactory(factory), mode=0o600)
+        task.LoopingCall(factory.sample_rates).start(factory._RATE_INTERVAL)
+        if hit_count_interval:
+            task.LoopingCall(factory.flush_hits).start(hit_count_interval, now=False)
+        rollup_interval = get_setting('ROLLUP_INTERVAL')
+        if rollup_interval and not worker_number:
+            # only one worker needs to do that
+            rollup_thread = RollupThread(rollup_interval)
+            rollup_thread.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', rollup_thread.stop)
+        reactor.addSystemEventTrigger('before', 'shutdown', self._shutdown, port, writer, factory)
         reactor.run()
 
+    @staticmethod
+    def _shutdown(port, writer, factory):
+        '''
+        Stops accepting new connections, closes the open ones, writes out everything still
+        pending (hit counts included), then saves the state for the next start
+        '''
+        logging.info('Shutting down')
+        port.stopListening()
+        # before the reactor does it, so that what they have left still makes it to the writer
+        factory.close_connections()
+        factory.flush_hits()
+        writer.stop()
+        factory.save_state()
+        logging.info('Shut down, stats: %s' % factory.stats)
+
+
+class ZomPHPSupervisor(object):
+    '''
+    Opens the socket once, then forks that many worker processes that all accept
+    connections on it, each with its own backend, and restarts them if they die
+    '''
+
+    # how long to wait before restarting a dead worker, so we don't spin if they crash on startup
+    _RESTART_DELAY = 1
+
+    def __init__(self, nb_workers, socket_path=SOCKET_PATH, control_socket_path=CONTROL_SOCKET_PATH):
+        self._nb_workers = nb_workers
+        self._socket_path = socket_path
+        self._control_socket_path = control_socket_path
+        # pid => worker number
+        self._workers = {}
+        self._stopping = False
+
+    def run(self):
+        listening_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listening_socket.bind(self._socket_path)
+        # same as what listenUNIX does, PHP processes usually run as another user
+        os.chmod(self._socket_path, 0o666)
+        listening_socket.listen(socket.SOMAXCONN)
+        listening_socket.setblocking(False)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for worker_number in range(self._nb_workers):
+            self._spawn_worker(listening_socket, worker_number)
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                raise
+            worker_number = self._workers.pop(pid, None)
+            if worker_number is not None and not self._stopping:
+                logging.error('Worker %d died (status %d), restarting it' % (pid, status))
+                time.sleep(self._RESTART_DELAY)
+                self._spawn_worker(listening_socket, worker_number)
+        logging.info('All workers stopped')
+
+    def _spawn_worker(self, listening_socket, worker_number):
+        pid = os.fork()
+        if pid:
+            logging.info('Started worker %d' % pid)
+            self._workers[pid] = worker_number
+            return
+        # in the worker
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            ZomPHPDaemon(self._socket_path, self._control_socket_path).run(listening_socket=listening_socket, worker_number=worker_number)
+        except:
+            logging.exception('Worker %d crashed' % os.getpid())
+            os._exit(1)
+        os._exit(0)
+
+    def _stop(self, signum, frame):
+        logging.info('Received signal %d, stopping the workers' % signum)
+        self._stopping = True
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def send_control_command(command, control_socket_path=CONTROL_SOCKET_PATH):
+    '''
+    Sends that command to all the running daemon processes,
+    and returns their responses indexed by control socket path
+    '''
+    responses = {}
+    for path in sorted(glob.glob('%s*' % control_socket_path)):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(path)
+            client.sendall('%s\n' % command)
+            response = ''
+            while not response.endswith('\n'):
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                response += chunk
+            responses[path] = json.loads(response)
+        except (socket.error, ValueError) as ex:
+            responses[path] = {'error': str(ex)}
+        finally:
+            client.close()
+    return responses
+
 
 def main():
     # argument processing
@@ -53,14 +586,37 @@ def main():
     parser.add_argument('--get-owner', dest='get_owner', action='store_const',
                         const=True, default=False, help='Outputs the deamon\'s owner'
                         ' as set in the configuration, then exits')
+    parser.add_argument('--stats', dest='stats', action='store_const',
+                        const=True, default=False, help='Outputs the running '
+                        'daemon\'s stats as JSON, then exits')
+    parser.add_argument('--set-log-level', dest='log_level', metavar='level',
+                        type=str, default=None, help='Changes the running '
+                        'daemon\'s log level, then exits')
+    parser.add_argument('--socket-path', dest='socket_path', metavar='path',
+                        type=str, default=None, help='Listens on that socket '
+                        'instead of the usual one, with the control socket at '
+                        '<path>.control (for testing purposes only, the PHP '
+                        'side always writes to %s)' % SOCKET_PATH)
     args = parser.parse_args()
+    if args.socket_path:
+        socket_paths = (args.socket_path, '%s.control' % args.socket_path)
+    else:
+        socket_paths = (SOCKET_PATH, CONTROL_SOCKET_PATH)
 
     if args.get_owner:
         print ZOMPHP_DEAMON_OWNER if ZOMPHP_DEAMON_OWNER else 'root'
+    elif args.stats:
+        print json.dumps(send_control_command('stats', socket_paths[1]), indent=2, sort_keys=True)
+    elif args.log_level:
+        print json.dumps(send_control_command('log_level %s' % args.log_level, socket_paths[1]), indent=2, sort_keys=True)
     else:
         # normal operation
         set_logger()
-        ZomPHPDaemon().run()
+        nb_workers = get_setting('DAEMON_WORKERS', 1)
+        if nb_workers > 1:
+            ZomPHPSupervisor(nb_workers, *socket_paths).run()
+        else:
+            ZomPHPDaemon(*socket_paths).run()
 
 
 if __name__ == '__main__':
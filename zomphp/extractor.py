@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import subprocess
+import json
+import hashlib
+import sqlite3
+
+
+# ugly, but eh...
+EXTRACT_EXEC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib', 'extract_functions.php')
+
+
+class FunctionExtractor(object):
+    '''
+    Keeps a lib/extract_functions.php process running in batch mode for the whole run,
+    and feeds it the paths of the files to extract functions from
+    The process gets (re-)started lazily, if PHP crashes on a file we just move on
+    PHP's errors go to stderr, so that the only thing on stdout is the JSON replies; still, if
+    we get a reply that's not the one we expect, we can't trust that process anymore and kill it
+    If given an ExtractionCache, unchanged files don't get parsed again
+    '''
+
+    def __init__(self, cache=None):
+        self._process = None
+        self._cache = cache
+
+    def _start(self):
+        logging.debug('Starting a new extractor process')
+        self._process = subprocess.Popen(['php', '-d', 'display_errors=stderr', EXTRACT_EXEC, '--batch'],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+
+    def extract(self, path):
+        '''
+        Returns the result from lib/extract_functions.php, i.e. a dict
+        mapping line numbers to lists of function names
+        '''
+        if self._cache is not None:
+            functions = self._cache.get(path)
+            if functions is not None:
+                return functions
+            # before extracting, so that changes made in the meantime don't get cached as the new version's
+            fingerprint = self._cache.fingerprint(path)
+        functions = self._do_extract(path)
+        if functions is None:
+            # failed, don't cache that
+            return {}
+        if self._cache is not None:
+            self._cache.set(path, functions, fingerprint)
+        return functions
+
+    def _do_extract(self, path):
+        '''
+        Same as `extract`, but returns None on failure
+        '''
+        if self._process is None or self._process.poll() is not None:
+            self._start()
+        try:
+            self._process.stdin.write('%s\n' % path)
+            self._process.stdin.flush()
+            data = self._process.stdout.readline()
+        except IOError as ex:
+            logging.error('Lost the extractor process while processing %s: %s' % (path, ex))
+            data = None
+        if not data:
+            logging.error('Failed to extract functions from %s: the extractor process died' % path)
+            self._stop()
+            return None
+        try:
+            result = json.loads(data)
+        except ValueError:
+            result = None
+        if not isinstance(result, dict) or result.get('path') != path:
+            logging.error('Failed to extract functions from %s: unexpected reply from the extractor process: %s' % (path, data.rstrip()))
+            # we're out of sync with that process, next replies could be for other files
+            self._kill()
+            return None
+        if 'error' in result:
+            logging.error('Failed to extract functions from %s: %s' % (path, result['error']))
+            return None
+        return {int(k): v for k, v in result['functions'].items()}
+
+    def close(self):
+        self._stop()
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+    def _kill(self):
+        try:
+            self._process.kill()
+            self._process.wait()
+        except OSError:
+            pass
+        self._process = None
+
+    def _stop(self):
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+            self._process.wait()
+        except (IOError, OSError):
+            pass
+        self._process = None
+
+
+class ExtractionCache(object):
+    '''
+    A persistent cache of lib/extract_functions.php's results, stored in a SQLite file
+    Entries are keyed by the files' real paths, and are only used as long as the file's
+    size and mtime, or failing that the hash of its contents, haven't changed
+    Several processes can safely share the same cache
+    '''
+
+    _FILE_NAME = 'extraction_cache.sqlite'
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(os.path.join(directory, self._FILE_NAME), timeout=60)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS extractions (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT, functions TEXT)')
+        self._connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(65536), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, path):
+        '''
+        Returns the cached functions for that file if it hasn't changed, None otherwise
+        '''
+        row = self._connection.execute('SELECT mtime, size, hash, functions FROM extractions WHERE path = ?', (path, )).fetchone()
+        if row is not None:
+            mtime, size, content_hash, functions = row
+            stat = os.stat(path)
+            if stat.st_size == size and (stat.st_mtime == mtime or self._hash(path) == content_hash):
+                if stat.st_mtime != mtime:
+                    # touched, but not changed
+                    self._execute('UPDATE extractions SET mtime = ? WHERE path = ?', (stat.st_mtime, path))
+                self.hits += 1
+                return {int(k): v for k, v in json.loads(functions).items()}
+        self.misses += 1
+        return None
+
+    def fingerprint(self, path):
+        '''
+        Returns the (mtime, size, hash) triple to pass to `set`
+        '''
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size, self._hash(path)
+
+    def set(self, path, functions, fingerprint):
+        '''
+        `fingerprint` must have been taken before extracting those functions
+        '''
+        self._execute('INSERT OR REPLACE INTO extractions (path, mtime, size, hash, functions) VALUES (?, ?, ?, ?, ?)',
+                      (path, ) + tuple(fingerprint) + (json.dumps(functions), ))
+
+    def prune(self):
+        '''
+        Removes the entries for files that have been deleted or modified since they were cached
+        Returns the number of entries removed
+        '''
+        stale = []
+        for path, mtime, size in self._connection.execute('SELECT path, mtime, size FROM extractions').fetchall():
+            try:
+                stat = os.stat(path)
+                if stat.st_size == size and stat.st_mtime == mtime:
+                    continue
+            except OSError:
+                pass
+            stale.append((path, ))
+        self._connection.executemany('DELETE FROM extractions WHERE path = ?', stale)
+        self._connection.commit()
+        return len(stale)
+
+    def _execute(self, query, params):
+        self._connection.execute(query, params)
+        self._connection.commit()
+
+    def close(self):
+        logging.info('Extraction cache: %d hits, %d misses' % (self.hits, self.misses))
+        self._connection.close()
+
+    @classmethod
+    def build_cache(cls, directory):
+        '''
+        Returns None if there's no directory, or if we can't use it
+        '''
+        if not directory:
+            return None
+        try:
+            return cls(directory)
+        except (OSError, sqlite3.Error) as ex:
+            logging.error('Can\'t use the extraction cache in %s, running without one: %s' % (directory, ex))
+            return None
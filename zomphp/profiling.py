@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import contextlib
+
+
+class Profiler(object):
+    '''
+    Records wall time and counts per phase (walking the tree, extracting functions,
+    each kind of backend call, rewriting files...) and keeps the slowest files
+    '''
+
+    def __init__(self, nb_slowest=10):
+        self._nb_slowest = nb_slowest
+        # phase => [count, seconds]
+        self._phases = {}
+        # a min-heap of (seconds, path)
+        self._slowest = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds, count=1):
+        totals = self._phases.setdefault(name, [0, 0.0])
+        totals[0] += count
+        totals[1] += seconds
+
+    def file_done(self, path, seconds):
+        if len(self._slowest) < self._nb_slowest:
+            heapq.heappush(self._slowest, (seconds, path))
+        elif self._nb_slowest:
+            heapq.heappushpop(self._slowest, (seconds, path))
+
+    def pop_data(self):
+        '''
+        Returns what's been recorded so far as a picklable object, and resets the profiler
+        (for worker processes to send their data to the parent's profiler)
+        '''
+        data = (self._phases, self._slowest)
+        self._phases = {}
+        self._slowest = []
+        return data
+
+    def merge_data(self, data):
+        phases, slowest = data
+        for name, (count, seconds) in phases.items():
+            self.add(name, seconds, count=count)
+        for seconds, path in slowest:
+            self.file_done(path, seconds)
+
+    @property
+    def summary(self):
+        return {'phases': {name: {'count': count, 'seconds': seconds} for name, (count, seconds) in self._phases.items()},
+                'slowest_files': [{'path': path, 'seconds': seconds} for seconds, path in sorted(self._slowest, reverse=True)]}
+
+
+class NullProfiler(object):
+    '''
+    Same interface as Profiler, doing nothing
+    '''
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        yield
+
+    def add(self, name, seconds, count=1):
+        pass
+
+    def file_done(self, path, seconds):
+        pass
+
+    def pop_data(self):
+        return None
+
+    def merge_data(self, data):
+        pass
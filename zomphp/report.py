@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+import json
+
+
+class Reporter(object):
+    '''
+    Streams one entry per function as files get processed, then per-directory totals,
+    as either NDJSON or CSV
+    Totals are rolled up to every parent directory, up to `root` if given
+    '''
+
+    FORMATS = ('ndjson', 'csv')
+
+    # the CSV columns, entries and totals share the same ones
+    _CSV_FIELDS = ('type', 'path', 'function', 'line', 'status', 'check', 'hits', 'functions', 'used', 'rarely_used', 'unused')
+
+    def __init__(self, output, output_format, root=None):
+        if output_format not in self.FORMATS:
+            raise ValueError('Unknown report format: %s' % output_format)
+        self._output = output
+        self._format = output_format
+        self._root = root.rstrip(os.sep) if root else None
+        # directory => [nb functions, nb used, nb rarely used]
+        self._totals = {}
+        if output_format == 'csv':
+            self._csv_writer = csv.DictWriter(output, self._CSV_FIELDS)
+            self._csv_writer.writeheader()
+
+    def report(self, path, function, lineno, used, check, hits=None, rarely_used=False):
+        '''
+        `check` is the name of the check that was applied to tell whether that function is used
+        `hits` is how many times it's been called, if known
+        '''
+        entry = {'type': 'function', 'path': path, 'function': function, 'line': lineno, 'check': check,
+                 'status': 'rarely_used' if rarely_used else 'used' if used else 'unused'}
+        if hits is not None:
+            entry['hits'] = hits
+        self._write(entry)
+        directory = os.path.dirname(path)
+        while True:
+            totals = self._totals.setdefault(directory, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += int(used)
+            totals[2] += int(rarely_used)
+            parent = os.path.dirname(directory)
+            if directory == self._root or parent == directory:
+                break
+            directory = parent
+
+    def close(self):
+        '''
+        Outputs the per-directory totals
+        '''
+        for directory, (functions, used, rarely_used) in sorted(self._totals.items()):
+            self._write({'type': 'directory', 'path': directory, 'functions': functions, 'used': used,
+                         'rarely_used': rarely_used, 'unused': functions - used})
+        self._output.flush()
+
+    def _write(self, entry):
+        if self._format == 'csv':
+            self._csv_writer.writerow(entry)
+        else:
+            self._output.write('%s\n' % json.dumps(entry, sort_keys=True))
+
+
+class CollectingReporter(object):
+    '''
+    Just keeps the entries, for worker processes to send them back to the parent's Reporter
+    '''
+
+    def __init__(self):
+        self.entries = []
+
+    def report(self, *entry):
+        self.entries.append(entry)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import zlib
+import struct
+import tempfile
+
+
+# A snapshot file is made of:
+#  * a header: the magic string, the format version, flags (one byte), the number of strings and
+#    the number of records
+#  * the string table: (number of strings + 1) offsets, followed by all the strings (file and
+#    function names), sorted, so that a string's id is its rank
+#  * the records: (filename id, line number, function id) triples, sorted
+# All integers are unsigned 4 bytes, in network order
+# Version 1 snapshots have no flags byte (and are read as if no flag was set)
+# A compressed snapshot is just a whole snapshot file compressed with zlib
+
+MAGIC = 'ZPSNAP'
+VERSION = 2
+
+# set if the records have line numbers, i.e. the snapshot can be used with the --strict option
+FLAG_LINE_NUMBERS = 1
+
+_HEADER = struct.Struct('!6sBBII')
+_HEADER_V1 = struct.Struct('!6sBII')
+_OFFSET = struct.Struct('!I')
+_RECORD = struct.Struct('!III')
+
+# zlib streams start with that byte with the default window size
+_ZLIB_MAGIC = '\x78'
+
+
+def _to_bytes(name):
+    return name.encode('utf-8') if isinstance(name, unicode) else name
+
+
+def write_snapshot(path, records, compress=False, line_numbers=True):
+    '''
+    Writes a snapshot of those (filename, function, lineno) records
+    `line_numbers` must be False if they come from a backend that doesn't record line numbers
+    Returns the number of distinct records written
+    '''
+    records = set((_to_bytes(filename), _to_bytes(function), int(lineno)) for filename, function, lineno in records)
+    strings = sorted(set(filename for filename, _, _ in records) | set(function for _, function, _ in records))
+    ids = {string: ident for ident, string in enumerate(strings)}
+
+    chunks = [_HEADER.pack(MAGIC, VERSION, FLAG_LINE_NUMBERS if line_numbers else 0, len(strings), len(records))]
+    offset = 0
+    for string in strings:
+        chunks.append(_OFFSET.pack(offset))
+        offset += len(string)
+    chunks.append(_OFFSET.pack(offset))
+    chunks.extend(strings)
+    chunks.extend(_RECORD.pack(*record) for record in sorted((ids[filename], lineno, ids[function]) for filename, function, lineno in records))
+    data = ''.join(chunks)
+    if compress:
+        data = zlib.compress(data)
+
+    # write to a temp file first, so that readers never see a half-written snapshot
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, prefix='.zomphp.', delete=False) as snapshot_file:
+        snapshot_file.write(data)
+    os.rename(snapshot_file.name, path)
+    return len(records)
+
+
+def merge_snapshots(output_path, input_paths, compress=False):
+    '''
+    Writes the union of the input snapshots
+    The result only has line numbers if all of them do
+    Returns the number of distinct records written
+    '''
+    records = set()
+    line_numbers = True
+    for input_path in input_paths:
+        snapshot = Snapshot(input_path)
+        records.update(snapshot)
+        line_numbers = line_numbers and snapshot.line_numbers
+        snapshot.close()
+    return write_snapshot(output_path, records, compress=compress, line_numbers=line_numbers)
+
+
+class Snapshot(object):
+    '''
+    Read-only access to a snapshot file, memory-mapped; lookups are binary searches
+    Compressed snapshots get decompressed into anonymous memory
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            if snapshot_file.read(1) == _ZLIB_MAGIC:
+                snapshot_file.seek(0)
+                data = zlib.decompress(snapshot_file.read())
+                self._map = mmap.mmap(-1, len(data))
+                self._map.write(data)
+            else:
+                self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack_from('!6sB', self._map)
+        if magic != MAGIC:
+            raise ValueError('%s is not a ZomPHP snapshot' % path)
+        if version == VERSION:
+            header = _HEADER
+            _, _, flags, self._nb_strings, self._nb_records = header.unpack_from(self._map)
+        elif version == 1:
+            header = _HEADER_V1
+            _, _, self._nb_strings, self._nb_records = header.unpack_from(self._map)
+            flags = 0
+        else:
+            raise ValueError('Unsupported snapshot version: %d' % version)
+        # whether the records have line numbers
+        self.line_numbers = bool(flags & FLAG_LINE_NUMBERS)
+        self._offsets_start = header.size
+        self._strings_start = self._offsets_start + (self._nb_strings + 1) * _OFFSET.size
+        string_offset, = _OFFSET.unpack_from(self._map, self._offsets_start + self._nb_strings * _OFFSET.size)
+        self._records_start = self._strings_start + string_offset
+
+    def __len__(self):
+        return self._nb_records
+
+    def _string(self, ident):
+        start, end = struct.unpack_from('!II', self._map, self._offsets_start + ident * _OFFSET.size)
+        return self._map[self._strings_start + start:self._strings_start + end]
+
+    def _string_id(self, string):
+        '''
+        Returns the id of that string, or None if it's not in the snapshot
+        '''
+        string = _to_bytes(string)
+        low, high = 0, self._nb_strings
+        while low < high:
+            middle = (low + high) // 2
+            if self._string(middle) < string:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._nb_strings and self._string(low) == string:
+            return low
+        return None
+
+    def _record(self, position):
+        return _RECORD.unpack_from(self._map, self._records_start + position * _RECORD.size)
+
+    def _lower_bound(self, key):
+        '''
+        Returns the position of the first record >= key
+        '''
+        low, high = 0, self._nb_records
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _file_records(self, filename_id):
+        '''
+        Yields the (filename id, lineno, function id) records for that file, by line number
+        '''
+        for position in xrange(self._lower_bound((filename_id, 0, 0)), self._lower_bound((filename_id + 1, 0, 0))):
+            yield self._record(position)
+
+    def likely_belongs(self, filename, function):
+        filename_id = self._string_id(filename)
+        function_id = self._string_id(function)
+        if filename_id is None or function_id is None:
+            return False
+        return any(record[2] == function_id for record in self._file_records(filename_id))
+
+    def next_func(self, filename, lineno):
+        filename_id = self._string_id(filename)
+        if filename_id is None:
+            return None
+        position = self._lower_bound((filename_id, int(lineno), 0))
+        if position < self._nb_records:
+            record = self._record(position)
+            if record[0] == filename_id:
+                return self._string(record[2])
+        return None
+
+    def file_records(self, filename):
+        filename_id = self._string_id(filename)
+        if filename_id is None:
+            return []
+        return [(lineno, self._string(function_id)) for _, lineno, function_id in self._file_records(filename_id)]
+
+    def __iter__(self):
+        '''
+        Yields all the (filename, function, lineno) records
+        '''
+        for position in xrange(self._nb_records):
+            filename_id, lineno, function_id = self._record(position)
+            yield self._string(filename_id), self._string(function_id), lineno
+
+    def close(self):
+        self._map.close()
@@ -4,7 +4,13 @@ import logging
 import sys
 import traceback
 import os
+import re
+import bisect
+import tempfile
+import time
+import cPickle
 
+import zomphp_settings
 from zomphp_settings import LOG_FILE, LOG_LEVEL
 
 
@@ -30,27 +36,228 @@ def set_logger(level=None):
         sys.excepthook = hook
 
 
-class PathTranslator(object):
+def get_setting(name, default=None):
     '''
-    @see the --path-translation option in zomphp.py
+    Returns that setting from zomphp_settings, or `default` if it's not defined there
+    (settings files are never overwritten on install, so they might come from an older version)
     '''
+    return getattr(zomphp_settings, name, default)
 
-    def __init__(self, paths_list):
-        if len(paths_list) % 2:
-            raise ValueError('You need to provide a list of pairs of path')
-        self._glossary = {(s if s.endswith(os.sep) else (s + os.sep)): t for s, t in zip(paths_list[::2], paths_list[1::2])}
+
+class SeenCache(object):
+    '''
+    A bounded "already seen" set, with generation-based eviction: keys live in
+    the current generation, and when it's full it becomes the previous one, and the
+    previous one gets dropped altogether. Keys seen again while in the previous
+    generation get promoted back into the current one, so it roughly behaves
+    like an LRU, but only costs a couple of dict lookups per call
+    Never holds more than `max_size` keys
+    If given a `max_age` (in seconds), keys are reported as not seen again that long after they
+    last were, even if they've been seen in the meantime, so that hot keys still get refreshed
+    '''
+
+    def __init__(self, max_size, max_age=None):
+        self._generation_size = max(1, max_size // 2)
+        self._max_age = max_age
+        # key => when it was last reported as not seen
+        self._current = {}
+        self._previous = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def seen(self, key):
+        '''
+        Returns True iff that key has been seen recently; otherwise records it and returns False
+        '''
+        reported = self._current.get(key)
+        in_current = reported is not None
+        if not in_current:
+            reported = self._previous.get(key)
+        # the date only matters if there is a max age
+        now = time.time() if self._max_age else 0
+        if reported is not None:
+            if not self._max_age or now - reported < self._max_age:
+                self.hits += 1
+                if not in_current:
+                    # keeps the date it was reported on
+                    self._add(key, reported)
+                return True
+            self.expired += 1
+        self.misses += 1
+        self._add(key, now)
+        return False
+
+    def discard(self, key):
+        '''
+        Forgets that key, e.g. if it didn't make it to the backend after all
+        '''
+        self._current.pop(key, None)
+        self._previous.pop(key, None)
+
+    def _add(self, key, reported):
+        if len(self._current) >= self._generation_size:
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = reported
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def save(self, path):
+        '''
+        Saves the cached keys to that file, so they can be re-loaded after a restart
+        '''
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with tempfile.NamedTemporaryFile('wb', dir=directory, prefix='.zomphp.', delete=False) as state_file:
+            cPickle.dump((self._previous, self._current), state_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(state_file.name, path)
+
+    def load(self, path):
+        '''
+        Loads keys saved by `save`, as many as fit
+        '''
+        with open(path, 'rb') as state_file:
+            previous, current = cPickle.load(state_file)
+        self._previous = self._trim(previous)
+        self._current = self._trim(current)
+
+    def _trim(self, generation):
+        if not isinstance(generation, dict):
+            # saved by an older version, as a list of keys, without the dates
+            now = time.time()
+            generation = {key: now for key in generation}
+        return dict(generation.items()[-self._generation_size:])
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'expired': self.expired, 'size': len(self)}
+
+
+class LatencyHistogram(object):
+    '''
+    Counts durations into buckets, whose upper bounds are in milliseconds
+    '''
+
+    _BOUNDS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
+    def __init__(self):
+        self._counts = [0] * (len(self._BOUNDS) + 1)
+        self._total = 0.0
+
+    def add(self, seconds):
+        milliseconds = seconds * 1000
+        self._counts[bisect.bisect_left(self._BOUNDS, milliseconds)] += 1
+        self._total += milliseconds
+
+    @property
+    def stats(self):
+        count = sum(self._counts)
+        buckets = [('<=%s' % bound, nb) for bound, nb in zip(self._BOUNDS, self._counts)]
+        buckets.append(('>%s' % self._BOUNDS[-1], self._counts[-1]))
+        return {'count': count, 'mean_ms': self._total / count if count else None, 'buckets_ms': dict(buckets)}
+
+
+class PathCanonicalizer(object):
+    '''
+    Rewrites the directory part of paths according to a list of rules, each of them either
+    ('prefix', source_prefix, target_prefix) or ('regex', pattern, replacement)
+    Prefix rules are compiled into a trie of path components, and the longest matching one wins;
+    regex rules are only tried, in order, if no prefix rule matches (they're applied to
+    directories, with a trailing separator)
+    Results are memoized per directory
+    '''
+
+    PREFIX = 'prefix'
+    REGEX = 'regex'
+
+    def __init__(self, rules, cache_size=100000):
+        # components => sub-trie, with the None key holding the target of the prefix ending there
+        self._trie = {}
+        self._regexes = []
+        for kind, source, target in rules:
+            if kind == self.PREFIX:
+                node = self._trie
+                for component in self._components(source):
+                    node = node.setdefault(component, {})
+                node[None] = target.rstrip(os.sep)
+            elif kind == self.REGEX:
+                self._regexes.append((re.compile(source), target))
+            else:
+                raise ValueError('Unknown path rule kind: %s' % kind)
+        self._cache = {}
+        self._cache_size = cache_size
+
+    @staticmethod
+    def _components(path):
+        return [component for component in path.split(os.sep) if component]
+
+    def _canonicalize_directory(self, directory):
+        components = self._components(directory)
+        node = self._trie
+        match = (0, node[None]) if None in node else None
+        for depth, component in enumerate(components, 1):
+            node = node.get(component)
+            if node is None:
+                break
+            if None in node:
+                match = (depth, node[None])
+        if match is not None:
+            depth, target = match
+            return target + ''.join(os.sep + component for component in components[depth:])
+        for regex, replacement in self._regexes:
+            new_directory, nb_subs = regex.subn(replacement, directory + os.sep, count=1)
+            if nb_subs:
+                return new_directory.rstrip(os.sep)
+        return directory
 
     def translate(self, path):
         '''
         Translates an absolute path
         '''
-        for s in self._glossary:
-            if path.startswith(s):
-                return os.path.join(self._glossary[s], path[len(s):])
+        directory, _, filename = path.rpartition(os.sep)
+        canonical_directory = self._cache.get(directory)
+        if canonical_directory is None:
+            canonical_directory = self._canonicalize_directory(directory)
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[directory] = canonical_directory
+        return '%s%s%s' % (canonical_directory, os.sep, filename)
+
+    @classmethod
+    def build_canonicalizer(cls):
+        '''
+        Returns a canonicalizer for the rules set in the settings, if any
+        '''
+        rules = get_setting('PATH_CANONICALIZATION_RULES')
+        if rules:
+            return cls(rules)
+        return None
+
+
+class PathTranslator(PathCanonicalizer):
+    '''
+    @see the --path-translation option in zomphp.py
+    Translated paths then get canonicalized the same way the daemon does it
+    '''
+
+    def __init__(self, paths_list, canonicalizer=None):
+        if len(paths_list) % 2:
+            raise ValueError('You need to provide a list of pairs of path')
+        super(PathTranslator, self).__init__([(self.PREFIX, s, t) for s, t in zip(paths_list[::2], paths_list[1::2])])
+        self._canonicalizer = canonicalizer
+
+    def translate(self, path):
+        path = super(PathTranslator, self).translate(path)
+        if self._canonicalizer is not None:
+            path = self._canonicalizer.translate(path)
         return path
 
     @classmethod
     def build_translator(cls, paths_list):
-        if paths_list:
-            return cls(paths_list)
+        canonicalizer = PathCanonicalizer.build_canonicalizer()
+        if paths_list or canonicalizer:
+            return cls(paths_list, canonicalizer=canonicalizer)
         return None
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import struct
+
+
+# The framed protocol:
+#  * a connection starts with the magic string, followed by the protocol version as one byte
+#  * then come frames, each made of its type (one byte), its payload's length (4 bytes) and its payload
+#  * FRAME_FILENAME and FRAME_FUNCTION frames declare names for the rest of the connection, their
+#    payload is an id (4 bytes) followed by the name
+#  * FRAME_RECORDS frames contain any number of records, each made of a filename id, a function id
+#    and a line number (4 bytes each)
+# All integers are unsigned, in network order
+# Text lines always start with a '/', so the first byte is enough to tell both protocols apart
+
+MAGIC = '\x00ZPB'
+VERSION = 1
+
+FRAME_FILENAME = 1
+FRAME_FUNCTION = 2
+FRAME_RECORDS = 3
+
+MAX_FRAME_SIZE = 1 << 20
+
+_HEADER = struct.Struct('!4sB')
+_FRAME_HEADER = struct.Struct('!BI')
+_ID = struct.Struct('!I')
+_RECORD = struct.Struct('!III')
+
+# the most records a FRAME_RECORDS frame can hold, and the longest name that can be declared
+_MAX_RECORDS_PER_FRAME = MAX_FRAME_SIZE // _RECORD.size
+_MAX_NAME_SIZE = MAX_FRAME_SIZE - _ID.size
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class TextDecoder(object):
+    '''
+    The original protocol: one path/to/file.php:funcName:lineNo record per line
+    Records split across reads get re-assembled
+    '''
+
+    def __init__(self):
+        self._partial = ''
+        self.errors = 0
+
+    def feed(self, data):
+        '''
+        Returns the complete records received so far, as strings
+        '''
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        return [line for line in lines if line]
+
+    def close(self):
+        '''
+        Returns whatever was left without a trailing new line
+        '''
+        partial, self._partial = self._partial, ''
+        return [partial] if partial else []
+
+
+class FramedDecoder(object):
+    '''
+    The framed protocol, see above
+    Records for names that haven't been declared are counted in `errors`, and dropped
+    '''
+
+    def __init__(self):
+        self._buffer = ''
+        self._header_read = False
+        self._names = {FRAME_FILENAME: {}, FRAME_FUNCTION: {}}
+        self.errors = 0
+
+    def feed(self, data):
+        '''
+        Returns the complete records received so far, as (filename, function, lineno) tuples
+        Raises a ProtocolError if the client doesn't follow the protocol
+        '''
+        records = []
+        data = self._buffer + data
+        offset = 0
+        if not self._header_read:
+            if len(data) < _HEADER.size:
+                self._buffer = data
+                return records
+            magic, version = _HEADER.unpack_from(data)
+            if magic != MAGIC:
+                raise ProtocolError('Not a ZomPHP framed connection')
+            if version != VERSION:
+                raise ProtocolError('Unsupported protocol version: %d' % version)
+            offset = _HEADER.size
+            self._header_read = True
+        while len(data) - offset >= _FRAME_HEADER.size:
+            frame_type, length = _FRAME_HEADER.unpack_from(data, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError('Frame too big: %d bytes' % length)
+            start = offset + _FRAME_HEADER.size
+            end = start + length
+            if end > len(data):
+                # wait for the rest
+                break
+            self._handle_frame(frame_type, data, start, end, records)
+            offset = end
+        self._buffer = data[offset:]
+        return records
+
+    def _handle_frame(self, frame_type, data, start, end, records):
+        if frame_type in self._names:
+            if end - start < _ID.size:
+                raise ProtocolError('Truncated declaration frame')
+            ident, = _ID.unpack_from(data, start)
+            self._names[frame_type][ident] = data[start + _ID.size:end]
+        elif frame_type == FRAME_RECORDS:
+            if (end - start) % _RECORD.size:
+                raise ProtocolError('Truncated records frame')
+            filenames = self._names[FRAME_FILENAME]
+            functions = self._names[FRAME_FUNCTION]
+            for position in xrange(start, end, _RECORD.size):
+                filename_id, function_id, lineno = _RECORD.unpack_from(data, position)
+                try:
+                    records.append((filenames[filename_id], functions[function_id], lineno))
+                except KeyError:
+                    self.errors += 1
+        else:
+            raise ProtocolError('Unknown frame type: %d' % frame_type)
+
+    def close(self):
+        if self._buffer:
+            # an incomplete frame, nothing we can do with it
+            self.errors += 1
+        return []
+
+
+def new_decoder(data):
+    '''
+    Returns the right decoder for a connection starting with those (non empty) data
+    '''
+    if data[0] == MAGIC[0]:
+        return FramedDecoder()
+    return TextDecoder()
+
+
+class FramedEncoder(object):
+    '''
+    The client side of the framed protocol
+    '''
+
+    def __init__(self):
+        self._header_sent = False
+        self._ids = {FRAME_FILENAME: {}, FRAME_FUNCTION: {}}
+
+    def _frame(self, frame_type, payload):
+        return _FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+    def _declare(self, frame_type, name, chunks):
+        ids = self._ids[frame_type]
+        ident = ids.get(name)
+        if ident is None:
+            ident = ids[name] = len(ids)
+            chunks.append(self._frame(frame_type, _ID.pack(ident) + name))
+        return ident
+
+    def encode(self, records):
+        '''
+        Returns the data to send for those (filename, function, lineno) records,
+        including the declarations of the names not sent yet on that connection
+        Records get split across as many frames as needed
+        Raises a ValueError if a name is too long to be declared, before encoding anything
+        '''
+        records = list(records)
+        for filename, function, _ in records:
+            if max(len(filename), len(function)) > _MAX_NAME_SIZE:
+                raise ValueError('Name too long to be declared: %d bytes' % max(len(filename), len(function)))
+        chunks = []
+        if not self._header_sent:
+            chunks.append(_HEADER.pack(MAGIC, VERSION))
+            self._header_sent = True
+        payload = []
+        for filename, function, lineno in records:
+            payload.append(_RECORD.pack(self._declare(FRAME_FILENAME, filename, chunks),
+                                        self._declare(FRAME_FUNCTION, function, chunks),
+                                        int(lineno)))
+            if len(payload) == _MAX_RECORDS_PER_FRAME:
+                chunks.append(self._frame(FRAME_RECORDS, ''.join(payload)))
+                payload = []
+        if payload:
+            chunks.append(self._frame(FRAME_RECORDS, ''.join(payload)))
+        return ''.join(chunks)
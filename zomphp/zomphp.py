@@ -4,9 +4,16 @@
 import argparse
 import sys
 import os
+import time
+import json
 import logging
+import cProfile
 
 import backend
+import extractor
+import profiling
+import report
+import snapshot
 import utils
 
 if os.path.exists('/etc/zomphp/zomphp_settings.py'):
@@ -39,6 +46,59 @@ def main():
                         default=[], help='A list of couples of paths to '
                         'translate (useful if running the code in a different '
                         'location than the one running the PHP code)')
+    parser.add_argument('--min-hits', dest='min_hits', metavar='N', type=int,
+                        default=None, help='Also flag the functions that have '
+                        'been called fewer than N times (requires a backend '
+                        'counting hits, see HIT_COUNT_INTERVAL in the settings)')
+    parser.add_argument('--jobs', dest='jobs', metavar='N', type=int,
+                        default=1, help='The number of processes to use to '
+                        'process files (only makes sense when used with the '
+                        '--dir option)')
+    parser.add_argument('--report', dest='report', metavar='format',
+                        type=str, choices=report.Reporter.FORMATS, default=None,
+                        help='Don\'t modify the files, output a report instead, '
+                        'in that format (one of %s)' % ', '.join(report.Reporter.FORMATS))
+    parser.add_argument('--report-file', dest='report_file', metavar='file_path',
+                        type=str, default=None, help='Where to write the report '
+                        '(defaults to the standard output)')
+    parser.add_argument('--rollup', dest='rollup', action='store_const',
+                        const=True, default=False, help='Rolls up the '
+                        'backend\'s records into durable storage (if the '
+                        'backend supports it), then exits')
+    parser.add_argument('--snapshot', dest='snapshot', metavar='snapshot_path',
+                        type=str, default=None, help='Look records up in that '
+                        'snapshot file instead of the backend set in the settings')
+    parser.add_argument('--export-snapshot', dest='export_snapshot',
+                        metavar='snapshot_path', type=str, default=None,
+                        help='Exports all the backend\'s records into that '
+                        'snapshot file, then exits')
+    parser.add_argument('--merge-snapshots', dest='merge_snapshots',
+                        metavar='snapshot_path', type=str, nargs='+', default=[],
+                        help='Writes the union of the snapshot files given '
+                        'after the first path to that first path (overwriting '
+                        'it), then exits')
+    parser.add_argument('--compress-snapshot', dest='compress_snapshot',
+                        action='store_const', const=True, default=False,
+                        help='Compress the snapshots written by --export-snapshot '
+                        'and --merge-snapshots (compressed snapshots get '
+                        'loaded in memory when used)')
+    parser.add_argument('--prune-extraction-cache', dest='prune_extraction_cache',
+                        action='store_const', const=True, default=False,
+                        help='Removes the entries for deleted or modified files '
+                        'from the extraction cache, then exits')
+    parser.add_argument('--profile', dest='profile', metavar='file_path',
+                        type=str, nargs='?', const='-', default=None,
+                        help='Time each phase of the processing (walking the '
+                        'directory, extracting functions, each kind of backend '
+                        'call, rewriting files), and write a JSON summary to '
+                        'that file at the end (defaults to the standard error)')
+    parser.add_argument('--profile-slowest', dest='profile_slowest', metavar='N',
+                        type=int, default=10, help='How many of the slowest '
+                        'files to list in the --profile summary')
+    parser.add_argument('--profile-dump', dest='profile_dump', metavar='file_path',
+                        type=str, default=None, help='Run under cProfile, and '
+                        'dump its stats to that file (only covers the main '
+                        'process when used with --jobs)')
     parser.add_argument('--logging-level', dest='logging_level', metavar='level',
                         type=str, nargs=1, default=None, help='A logging '
                         'level to override the one set in the settings file')
@@ -47,6 +107,35 @@ def main():
     # start the logger
     utils.set_logger()
 
+    if args.prune_extraction_cache:
+        cache = extractor.ExtractionCache.build_cache(utils.get_setting('EXTRACTION_CACHE_DIR'))
+        if cache is None:
+            logging.error('No usable EXTRACTION_CACHE_DIR set in the settings, exiting')
+            sys.exit(1)
+        logging.info('Pruned %d entries from the extraction cache' % cache.prune())
+        cache.close()
+        return
+
+    if args.export_snapshot:
+        bckend = backend.get_new_backend()
+        nb_records = snapshot.write_snapshot(args.export_snapshot, bckend.iter_records(), compress=args.compress_snapshot, line_numbers=bckend.supports_strict)
+        logging.info('Exported %d records to %s' % (nb_records, args.export_snapshot))
+        bckend.close()
+        return
+    if args.merge_snapshots:
+        if len(args.merge_snapshots) < 2:
+            logging.error('The --merge-snapshots option requires an output path and at least one input path, exiting')
+            sys.exit(1)
+        nb_records = snapshot.merge_snapshots(args.merge_snapshots[0], args.merge_snapshots[1:], compress=args.compress_snapshot)
+        logging.info('Merged %d records into %s' % (nb_records, args.merge_snapshots[0]))
+        return
+
+    if args.rollup:
+        bckend = backend.get_new_backend()
+        bckend.rollup()
+        bckend.close()
+        return
+
     # some sanity checks
     def check_abs_path(path, option_name):
         # helper function, checks the paths are absolute, and translates them to real paths
@@ -68,20 +157,62 @@ def main():
             args.ignore_sub_dirs = check_abs_path(args.ignore_sub_dirs, 'ignore-sub-dirs')
         else:
             logging.warning('Ignoring the --ignore-sub-dirs option, that option can only be used together with the --dir option')
+    if args.jobs != 1 and not args.dir:
+        logging.warning('Ignoring the --jobs option, that option can only be used together with the --dir option')
     translator = utils.PathTranslator.build_translator(args.path_translation)
+    reporter = None
+    if args.report:
+        report_output = open(args.report_file, 'w') if args.report_file else sys.stdout
+        reporter = report.Reporter(report_output, args.report, root=args.dir[0] if args.dir else None)
+    elif args.report_file:
+        logging.warning('Ignoring the --report-file option, that option can only be used together with the --report option')
 
     # down to work!
-    bckend = backend.get_new_backend()
+    start = time.time()
+    bckend = backend.SnapshotBackend(args.snapshot) if args.snapshot else backend.get_new_backend()
+    if args.strict and args.snapshot and not bckend.supports_strict:
+        logging.error('The --strict option can\'t be used with %s, it\'s been exported from a backend without line numbers, exiting' % args.snapshot)
+        sys.exit(1)
+    if args.strict and not bckend.supports_strict:
+        logging.error('The --strict option is not supported by %s, exiting' % bckend.__class__.__name__)
+        sys.exit(1)
+    if args.min_hits and not bckend.counts_hits:
+        logging.error('The --min-hits option requires a backend counting hits, exiting')
+        sys.exit(1)
+    if args.profile:
+        bckend.profiler = profiling.Profiler(args.profile_slowest)
+    c_profiler = cProfile.Profile() if args.profile_dump else None
+    if c_profiler is not None:
+        c_profiler.enable()
 
     if args.dir:
-        bckend.process_directory(args.dir[0], strict=args.strict, ignore_sub_dirs=args.ignore_sub_dirs, translator=translator)
+        bckend.process_directory(args.dir[0], strict=args.strict, ignore_sub_dirs=args.ignore_sub_dirs, translator=translator, jobs=args.jobs, reporter=reporter, min_hits=args.min_hits)
     else:
         # then it must be --files
         for fle in args.files:
-            bckend.process_file(fle, args.strict, translator=translator)
+            bckend.process_file(fle, args.strict, translator=translator, reporter=reporter, min_hits=args.min_hits)
 
+    with bckend.profiler.phase('backend.close'):
+        bckend.close()
+    if c_profiler is not None:
+        c_profiler.disable()
+        c_profiler.dump_stats(args.profile_dump)
+    if reporter is not None:
+        reporter.close()
     logging.info(bckend.stats)
 
+    if args.profile:
+        summary = bckend.profiler.summary
+        summary.update({'total_seconds': time.time() - start,
+                        'jobs': args.jobs,
+                        'files': bckend._nb_files_processed,
+                        'functions': bckend._functions_found,
+                        'used_functions': bckend._functions_used})
+        profile_output = sys.stderr if args.profile == '-' else open(args.profile, 'w')
+        profile_output.write('%s\n' % json.dumps(summary, indent=2, sort_keys=True))
+        if profile_output is not sys.stderr:
+            profile_output.close()
+
 
 if __name__ == '__main__':
     main()
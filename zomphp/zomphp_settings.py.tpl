@@ -4,19 +4,87 @@
 BACKEND_CLASS_NAME = 'DummyBackend'
 BACKEND_KWARGS = {}
 
+# Example for a local SQLite backend
+# BACKEND_CLASS_NAME = 'SqliteBackend'
+# BACKEND_KWARGS = {
+#     'path': '/var/lib/zomphp/zomphp.sqlite', # must be writable by the daemon's owner
+#     'batch_size': 1000, # records are written in batched transactions...
+#     'batch_interval': 1, # ... at least every that many seconds
+#     'max_buffered': 100000, # how many records to keep while writes are failing
+#     'counting': False, # keep hit counts, see HIT_COUNT_INTERVAL
+# }
+
 # Example for a Mongo backend
 # BACKEND_CLASS_NAME = 'MongoBackend'
 # BACKEND_KWARGS = {
 #     'db_name': 'XXX',
 #     'col_name': 'XXX',
 #     'size': 104857600, # 100 MB
-#     'host': 'XXX'
+#     'host': 'XXX',
+#     'batch_size': 1000, # records are written in bulk...
+#     'batch_interval': 1, # ... at least every that many seconds
+#     'max_buffered': 100000, # how many records to keep while writes are failing
+#     'compact': False, # store integer ids instead of file names...
+#     'compact_functions': False, # ... and of function names
+#     'aggregate': False, # keep a durable copy of the capped collection, see ROLLUP_INTERVAL
+#     'counting': False, # keep hit counts in a separate collection, see HIT_COUNT_INTERVAL
 # }
 
 
+# the number of daemon processes accepting connections on ZomPHP's socket,
+# each of them with its own backend connection (crashed ones get restarted)
+DAEMON_WORKERS = 1
+
+# how often (in seconds) the daemon rolls up the backend's records into durable storage
+# (only for Mongo backends with 'aggregate' set; set to None to disable, you can
+# also run `zomphp/zomphp.py --rollup` from a cron job)
+ROLLUP_INTERVAL = 3600
+
+# the daemon keeps that many recently recorded entries in memory, and doesn't
+# send them to the backend again (set to 0 to disable)
+DEDUP_CACHE_SIZE = 100000
+# entries older than that (in seconds) get sent to the backend again anyway, so that
+# records for hot functions don't fall out of a capped collection for good; should be
+# well below the time it takes the capped collection to wrap (set to None to disable)
+DEDUP_MAX_AGE = 3600
+# where the daemon saves that cache when stopped, to re-load it when started again, so that
+# restarts don't flood the backend with writes (set to None to disable)
+STATE_FILE = '/var/lib/zomphp/daemon.state' # the daemon's owner must have the right to write in there
+
+# how often (in seconds) the daemon makes the backend write out what it has buffered
+FLUSH_INTERVAL = 1
+
+# the daemon writes to the backend from a separate thread, through a queue holding at most
+# that many records, so that PHP processes never wait on the backend
+WRITE_QUEUE_SIZE = 100000
+# what to do when that queue is full: one of 'drop_oldest', 'drop_new' or 'block'
+WRITE_QUEUE_OVERFLOW_POLICY = 'drop_oldest'
+
+# how often (in seconds) the daemon sends the numbers of calls it has counted to the backend
+# (only for backends with 'counting' set, which lets `zomphp/zomphp.py --min-hits N` flag
+# rarely used functions; set to None to disable)
+HIT_COUNT_INTERVAL = None
+
+
+# rules to canonicalize the file paths before recording them, so that e.g. deploying to a new
+# release directory doesn't make the daemon record the whole working set all over again
+# (zomphp.py applies the same rules when looking up functions)
+# each rule is either ('prefix', '/srv/releases/current/', '/srv/app/'),
+# or a regex applied to directories, e.g. ('regex', r'^/srv/releases/[^/]+/', '/srv/app/')
+# the longest matching prefix rule wins, regexes are only tried if no prefix rule matches
+PATH_CANONICALIZATION_RULES = []
+
+
+# where zomphp.py caches the functions it finds in PHP files, so that
+# files that haven't changed since the last run don't need to be parsed again
+# (set to None to disable)
+EXTRACTION_CACHE_DIR = '/var/cache/zomphp'
+
+
 # logging options
 LOG_FILE = '/var/log/zomphp.log' # the daemon's owner must obviously have the right to write in there
-LOG_LEVEL = 'DEBUG' # one of 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL', otherwise defaults to 'INFO'
+LOG_LEVEL = 'INFO' # one of 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL', otherwise defaults to 'INFO'
+# (can be changed at runtime with `zomphp/daemon.py --set-log-level LEVEL`)
 
 
 # the user to run ZomPHP's daemon as